@@ -47,6 +47,12 @@ SCHEMA = {
         'task_expiration': {
             'type': 'integer', 'minimum': 0,
         },
+        'message_codec': {
+            'type': 'string', 'enum': ['json', 'msgpack'],
+        },
+        'compress_threshold': {
+            'type': 'integer', 'minimum': 0,
+        },
         'suppress': {
             'type': 'object',
             'properties': {
@@ -61,6 +67,60 @@ SCHEMA = {
         'probe': {
             'type': 'object',
             'properties': {
+                'concurrency': {
+                    'type': 'integer', 'minimum': 1,
+                },
+                'receive_batch_size': {
+                    'type': 'integer', 'minimum': 1, 'maximum': 10,
+                },
+                'delete_batch_size': {
+                    'type': 'integer', 'minimum': 1, 'maximum': 10,
+                },
+                'result_batch_size': {
+                    'type': 'integer', 'minimum': 1,
+                },
+                'result_batch_time': {
+                    'type': 'integer', 'minimum': 0,
+                },
+                'template_cache_size': {
+                    'type': 'integer', 'minimum': -1,
+                },
+                'template_cache_dir': {
+                    'type': ['string', 'null'],
+                },
+                'state_cache_size': {
+                    'type': 'integer', 'minimum': 0,
+                },
+                'state_cache_ttl': {
+                    'type': 'integer', 'minimum': 0,
+                },
+                'visibility_timeout': {
+                    'type': 'integer', 'minimum': 0,
+                },
+                'heartbeat_interval': {
+                    'type': 'integer', 'minimum': 1,
+                },
+                'direct_exec': {
+                    'type': 'boolean',
+                },
+                'fork_server': {
+                    'type': 'boolean',
+                },
+                'max_output': {
+                    'type': 'integer', 'minimum': 0,
+                },
+                'telemetry_interval': {
+                    'type': 'integer', 'minimum': 0,
+                },
+                'result_telemetry': {
+                    'type': 'boolean',
+                },
+                'realm_weights': {
+                    'type': 'object',
+                    'additionalProperties': {
+                        'type': 'integer', 'minimum': 1,
+                    },
+                },
                 'max_retries': {
                     'type': 'integer', 'minimum': 0,
                 },
@@ -87,6 +147,18 @@ SCHEMA = {
                 'visibility_timeout': {
                     'type': 'integer', 'minimum': 5,
                 },
+                'receive_batch_size': {
+                    'type': 'integer', 'minimum': 1, 'maximum': 10,
+                },
+                'delete_batch_size': {
+                    'type': 'integer', 'minimum': 1, 'maximum': 10,
+                },
+                'handler_workers': {
+                    'type': 'integer', 'minimum': 1,
+                },
+                'handler_timeout': {
+                    'type': 'integer', 'minimum': 0,
+                },
             },
         },
         'scheduler': {
@@ -95,6 +167,24 @@ SCHEMA = {
                 'interval': {
                     'type': 'integer', 'minimum': 30,
                 },
+                'dispatch': {
+                    'type': 'string', 'enum': ['burst', 'spread', 'due'],
+                },
+                'batch_size': {
+                    'type': 'integer', 'minimum': 1, 'maximum': 10,
+                },
+                'writers': {
+                    'type': 'integer', 'minimum': 1,
+                },
+                'backlog_limit': {
+                    'type': 'integer', 'minimum': 0,
+                },
+                'backlog_policy': {
+                    'type': 'string', 'enum': ['skip', 'thin'],
+                },
+                'compact_tasks': {
+                    'type': 'boolean',
+                },
                 'backend': {
                     'type': 'string',
                 },
@@ -107,6 +197,12 @@ SCHEMA = {
                 'lock_args': {
                     'type': 'object',
                 },
+                'membership_backend': {
+                    'type': ['string', 'null'],
+                },
+                'membership_args': {
+                    'type': 'object',
+                },
             },
         },
     }
@@ -121,8 +217,27 @@ DEFAULTS = {
     'results_topic': 'nymms_results',
     'private_context_file': os.path.join(default_conf_dir, 'private.yaml'),
     'task_expiration': 600,
+    'message_codec': 'json',
+    'compress_threshold': 0,
 
     'probe': {
+        'concurrency': 1,
+        'receive_batch_size': 10,
+        'delete_batch_size': 10,
+        'result_batch_size': 1,
+        'result_batch_time': 1000,
+        'template_cache_size': 400,
+        'template_cache_dir': None,
+        'state_cache_size': 0,
+        'state_cache_ttl': 300,
+        'visibility_timeout': 30,
+        'heartbeat_interval': 10,
+        'direct_exec': True,
+        'fork_server': False,
+        'max_output': 8192,
+        'telemetry_interval': 300,
+        'result_telemetry': False,
+        'realm_weights': {},
         'max_retries': 2,
         'queue_wait_time': 20,
         'retry_delay': 30,
@@ -133,10 +248,20 @@ DEFAULTS = {
         'queue_name': 'reactor_queue',
         'queue_wait_time': 20,
         'visibility_timeout': 30,
+        'receive_batch_size': 10,
+        'delete_batch_size': 10,
+        'handler_workers': 1,
+        'handler_timeout': 30,
     },
 
     'scheduler': {
         'interval': 300,
+        'dispatch': 'burst',
+        'batch_size': 10,
+        'writers': 1,
+        'backlog_limit': 0,
+        'backlog_policy': 'thin',
+        'compact_tasks': False,
         'backend': 'nymms.scheduler.backends.yaml_backend.YamlBackend',
         'backend_args': {
             'path': os.path.join(default_conf_dir, 'nodes.yaml'),
@@ -147,6 +272,12 @@ DEFAULTS = {
             'domain_name': 'nymms_locks',
             'lock_name': 'scheduler_lock',
         },
+        'membership_backend': None,
+        'membership_args': {
+            'duration': 360,
+            'domain_name': 'nymms_schedulers',
+            'group_name': 'schedulers',
+        },
     },
 
     'suppress': {
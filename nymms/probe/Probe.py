@@ -1,11 +1,16 @@
 import logging
+import sys
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
 from nymms.schemas import Result, types
 from nymms.daemon import NymmsDaemon
-from nymms.resources import Monitor
+from nymms.resources import Monitor, build_task_context
 from nymms.utils import commands
+from nymms.utils.cache import LRUCache
+from nymms.probe.telemetry import Telemetry, METRICS
 from nymms.config.yaml_config import load_config, EmptyConfig
 
 import arrow
@@ -14,8 +19,17 @@ import arrow
 TIMEOUT_OUTPUT = "Command timed out after %d seconds."
 
 
+# Marks a task with no previous state in the state cache
+NO_STATE = object()
+
+
 class Probe(NymmsDaemon):
     state_manager = None
+    state_cache = None
+    telemetry = None
+    # The version of the local resources, see load_resources
+    resources_version = None
+    _mismatched_versions = frozenset()
 
     def get_private_context(self, private_context_file):
         if not private_context_file:
@@ -33,7 +47,25 @@ class Probe(NymmsDaemon):
     #       methods since in reality all reactors should have some sort of
     #       state backend, even if its a no-op
     def get_state(self, task_id):
-        return self.state_manager.get_state(task_id)
+        if self.state_cache is not None:
+            state = self.state_cache.get(task_id)
+            if state is not None:
+                logger.debug("%s - using cached state.", task_id)
+                return None if state is NO_STATE else state
+        state = self.state_manager.get_state(task_id)
+        if self.state_cache is not None:
+            self.state_cache.set(task_id, state or NO_STATE)
+        return state
+
+    def update_state_cache(self, task_id, result, previous_state):
+        """ Caches the state that the reactor will store for this result, so
+        that the next run of the task doesn't need to look it up.
+        """
+        if self.state_cache is None:
+            return
+        new_state = self.state_manager.build_new_state(task_id, result,
+                                                       previous_state)
+        self.state_cache.set(task_id, new_state)
 
     def get_task(self, **kwargs):
         raise NotImplementedError
@@ -47,6 +79,12 @@ class Probe(NymmsDaemon):
     def delete_task(self, task):
         raise NotImplementedError
 
+    def release_task(self, task, delay):
+        """ Hands a task back to the queue without handling or deleting it,
+        for any probe to pick up again after delay seconds.
+        """
+        raise NotImplementedError
+
     def execute_task(self, task, timeout, **kwargs):
         log_prefix = "%s - " % (task.id,)
         monitor = Monitor.registry[task.context['monitor']['name']]
@@ -54,12 +92,18 @@ class Probe(NymmsDaemon):
         current_attempt = int(task.attempt) + 1
         logger.debug(log_prefix + "attempt %d, executing: %s", current_attempt,
                      command)
+        # The result carries the task's message, so that the task isn't
+        # deleted before its result has been submitted.
         result = Result({'id': task.id,
                          'timestamp': task.created,
-                         'task_context': task.context})
+                         'task_context': task.context},
+                        origin=task._origin)
+        stats = {}
+        start = time.time()
+        timed_out = False
         try:
             output = monitor.execute(task.context, timeout,
-                                     self._private_context)
+                                     self._private_context, stats)
             result.output = output
             result.state = types.STATE_OK
         except commands.CommandException as e:
@@ -67,15 +111,32 @@ class Probe(NymmsDaemon):
                 result.state = e.return_code
                 result.output = e.output
             if isinstance(e, commands.CommandTimeout):
+                timed_out = True
                 result.state = types.STATE_UNKNOWN
                 result.output = (TIMEOUT_OUTPUT % timeout)
         except Exception as e:
             result.state = types.STATE_UNKNOWN
             result.output = str(e)
         result.state_type = types.STATE_TYPE_HARD
+        sample = {
+            'wall_time': stats.get('elapsed', time.time() - start),
+            'queue_wait': max(start - task.created.float_timestamp, 0),
+            'cpu_user': stats.get('cpu_user'),
+            'cpu_system': stats.get('cpu_system'),
+            'timed_out': timed_out}
+        self.record_telemetry(task, sample)
+        if kwargs.get('result_telemetry'):
+            result.telemetry = dict((m, sample[m]) for m in METRICS
+                                    if sample[m] is not None)
         result.validate()
         return result
 
+    def record_telemetry(self, task, sample):
+        if self.telemetry is None:
+            return
+        node = task.context.get('node', {}).get('name')
+        self.telemetry.record(task.context['monitor']['name'], node, sample)
+
     def expire_task(self, task, task_expiration):
         if task_expiration:
             now = arrow.get()
@@ -87,11 +148,44 @@ class Probe(NymmsDaemon):
             return False
         return False
 
+    def version_matches(self, task):
+        """ Returns True if a compact task (see Scheduler.make_task) was
+        scheduled with the same version of the resources as the probe's.
+        """
+        version = task.reference.get('version')
+        if version == self.resources_version:
+            return True
+        if version not in self._mismatched_versions:
+            self._mismatched_versions = self._mismatched_versions | set(
+                [version])
+            logger.warning("Tasks are being scheduled with resources version "
+                           "%s, local version is %s.  Handing them back for "
+                           "a probe with the same resources.", version,
+                           self.resources_version)
+        return False
+
+    def expand_task(self, task):
+        """ Rebuilds the full context of a compact task (see
+        Scheduler.make_task) from the local resources.  Returns False if
+        that isn't possible.
+        """
+        try:
+            task.context = build_task_context(task.reference, task.context)
+        except KeyError as e:
+            logger.error("%s - unable to build task context, %s is missing "
+                         "from the local resources (version %s).", task.id,
+                         e, self.resources_version)
+            return False
+        task.reference = None
+        return True
+
     def handle_task(self, task, **kwargs):
         log_prefix = "%s - " % (task.id,)
         task_expiration = kwargs.get('task_expiration', None)
         if self.expire_task(task, task_expiration):
             return None
+        if task.reference and not self.expand_task(task):
+            return None
         # Used to add the command context to the task
         monitor = Monitor.registry[task.context['monitor']['name']]
         command = monitor.command
@@ -131,21 +225,67 @@ class Probe(NymmsDaemon):
             else:
                 logger.debug("Retry limit hit, not resubmitting.")
         result.validate()
+        self.update_state_cache(task.id, result, previous_state)
         return result
 
-    def run(self, **kwargs):
-        """ This will run in a tight loop. It is expected that the subclass's
-        get_task() method will introduce a delay if the results queue is
-        empty.
+    def process_tasks(self, **kwargs):
+        """ Pulls tasks off the queue and handles them, one at a time, until
+        the process exits.  Each task is fully handled (including submitting
+        the result) before it is deleted from the queue.
+
+        Compact tasks scheduled with a different version of the resources
+        can't be rebuilt correctly here, so they're handed back to the queue
+        (after retry_delay) for a probe that has the same version.
         """
-        private_context_file = kwargs.get('private_context_file', None)
-        self._private_context = self.get_private_context(private_context_file)
         while True:
             task = self.get_task(**kwargs)
             if not task:
                 logger.debug("Task queue is empty.")
                 continue
+            if task.reference and not self.version_matches(task):
+                self.release_task(task, kwargs.get('retry_delay'))
+                continue
             result = self.handle_task(task, **kwargs)
             if result:
                 self.submit_result(result, **kwargs)
             self.delete_task(task)
+
+    def run(self, **kwargs):
+        """ This will run in a tight loop. It is expected that the subclass's
+        get_task() method will introduce a delay if the results queue is
+        empty.
+
+        If concurrency is greater than 1 then that many worker threads are
+        started, each running process_tasks, so that multiple tasks can be
+        in flight at the same time.
+        """
+        self.resources_version = kwargs.get('resources_version')
+        private_context_file = kwargs.get('private_context_file', None)
+        self._private_context = self.get_private_context(private_context_file)
+        state_cache_size = kwargs.get('state_cache_size')
+        if state_cache_size:
+            self.state_cache = LRUCache(state_cache_size,
+                                        kwargs.get('state_cache_ttl'))
+        self.telemetry = Telemetry()
+        telemetry_interval = kwargs.get('telemetry_interval')
+        if telemetry_interval:
+            self.telemetry.start_reporter(telemetry_interval)
+        concurrency = kwargs.get('concurrency') or 1
+        if concurrency == 1:
+            return self.process_tasks(**kwargs)
+        logger.info("Starting %d probe workers.", concurrency)
+        workers = []
+        for i in range(concurrency):
+            worker = threading.Thread(target=self.process_tasks,
+                                      name='probe-worker-%d' % (i,),
+                                      kwargs=kwargs)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        while True:
+            for worker in workers:
+                worker.join(1)
+                if not worker.is_alive():
+                    logger.error("Probe worker %s died, exiting.",
+                                 worker.name)
+                    sys.exit(1)
@@ -0,0 +1,249 @@
+""" Native checks that run inside the probe rather than forking a plugin.
+
+Each check is a callable that takes the command context and a timeout and
+returns a tuple of (return_code, output), using the same exit codes and
+output conventions as nagios plugins.  To use one, point a 'python' type
+command at it in resources.yaml:
+
+    commands:
+      check_http:
+        command_type: python
+        command_string: nymms.probe.checks.check_http
+        warn_timeout: 1
+        crit_timeout: 10
+"""
+
+import datetime
+import logging
+import os
+import socket
+import ssl
+import time
+import httplib
+
+logger = logging.getLogger(__name__)
+
+from nymms.schemas import types
+
+import arrow
+
+
+def _state(context, elapsed):
+    """ Returns the state for a response time given the warn_timeout and
+    crit_timeout in the context.
+    """
+    crit_timeout = context.get('crit_timeout')
+    warn_timeout = context.get('warn_timeout')
+    if crit_timeout is not None and elapsed > float(crit_timeout):
+        return types.STATE_CRITICAL
+    if warn_timeout is not None and elapsed > float(warn_timeout):
+        return types.STATE_WARNING
+    return types.STATE_OK
+
+
+def _threshold(context, key):
+    value = context.get(key)
+    if value is None:
+        return ''
+    return '%f' % float(value)
+
+
+def _time_perfdata(context, elapsed):
+    return 'time=%fs;%s;%s;0.000000' % (elapsed,
+                                        _threshold(context, 'warn_timeout'),
+                                        _threshold(context, 'crit_timeout'))
+
+
+def _ssl_context(context, verify=False):
+    ssl_context = ssl.create_default_context(cafile=context.get('ca_file'))
+    if not verify:
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
+
+def check_http(context, timeout, use_ssl=False):
+    """ Checks the status and response time of an HTTP(S) url.
+
+    Context: address, port, url, use_ssl, warn_timeout, crit_timeout,
+    minimum_size.
+
+    2xx and 3xx responses are OK, 4xx are WARNING and 5xx are CRITICAL, as
+    with check_http.
+    """
+    use_ssl = context.get('use_ssl', use_ssl)
+    address = context['address']
+    port = context.get('port')
+    url = context.get('url', '/')
+    label = 'HTTPS' if use_ssl else 'HTTP'
+    if use_ssl:
+        connection = httplib.HTTPSConnection(address, port, timeout=timeout,
+                                             context=_ssl_context(context))
+    else:
+        connection = httplib.HTTPConnection(address, port, timeout=timeout)
+    start = time.time()
+    try:
+        connection.request('GET', url)
+        response = connection.getresponse()
+        body = response.read()
+    except (socket.error, httplib.HTTPException) as e:
+        if isinstance(e, socket.timeout):
+            raise
+        return (types.STATE_CRITICAL.code,
+                '%s CRITICAL - Unable to fetch %s: %s' % (label, url, e))
+    finally:
+        connection.close()
+    elapsed = time.time() - start
+
+    status = '%d %s' % (response.status, response.reason)
+    if response.status >= 500:
+        state = types.STATE_CRITICAL
+    elif response.status >= 400:
+        state = types.STATE_WARNING
+    else:
+        state = _state(context, elapsed)
+    minimum_size = context.get('minimum_size')
+    if (state == types.STATE_OK and minimum_size is not None and
+            len(body) < int(minimum_size)):
+        state = types.STATE_WARNING
+    output = ('%s %s: HTTP/1.1 %s - %d bytes in %.3f second response time '
+              '|%s size=%dB;;;0' % (label, state.name.upper(), status,
+                                    len(body), elapsed,
+                                    _time_perfdata(context, elapsed),
+                                    len(body)))
+    return state.code, output
+
+
+def check_https(context, timeout):
+    """ check_http, with use_ssl defaulting to True. """
+    return check_http(context, timeout, use_ssl=True)
+
+
+def _der_item(der, offset):
+    """ Returns the tag of the DER item at offset, and where its contents
+    start and end.
+    """
+    tag = ord(der[offset])
+    length = ord(der[offset + 1])
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = int(der[offset:offset + size].encode('hex'), 16)
+        offset += size
+    return tag, offset, offset + length
+
+
+def _cert_not_after(der):
+    """ Returns when a DER encoded certificate expires.
+
+    Unverified certificates aren't decoded by the ssl module, so this walks
+    just far enough into the certificate to find its validity.
+    """
+    # Certificate -> tbsCertificate
+    _, start, _ = _der_item(der, 0)
+    _, start, _ = _der_item(der, start)
+    tag, _, end = _der_item(der, start)
+    if tag == 0xa0:
+        # Skip the (explicitly tagged) version
+        start = end
+    # Skip the serial number, signature algorithm and issuer
+    for i in range(3):
+        _, _, start = _der_item(der, start)
+    # validity -> notBefore, notAfter
+    _, start, _ = _der_item(der, start)
+    _, _, start = _der_item(der, start)
+    tag, start, end = _der_item(der, start)
+    value = der[start:end]
+    if tag == 0x17:
+        # UTCTime, with a two digit year
+        year = int(value[:2])
+        value = '%d%s' % (year + (1900 if year >= 50 else 2000), value[2:])
+    return arrow.get(datetime.datetime.strptime(value[:14], '%Y%m%d%H%M%S'))
+
+
+def check_cert(context, timeout):
+    """ Checks how long until the TLS certificate served by a host expires.
+
+    Like check_http -C the certificate isn't verified by default, so that
+    self-signed & private CA certificates can be checked too.  If verify is
+    set, or a ca_file is given, the certificate also has to verify against
+    the system CAs (or the ca_file).
+
+    Context: address, port, cert_days, verify, ca_file.
+    """
+    address = context['address']
+    port = int(context.get('port', 443))
+    cert_days = int(context.get('cert_days', 30))
+    verify = bool(context.get('verify') or context.get('ca_file'))
+    ssl_context = _ssl_context(context, verify=verify)
+    try:
+        sock = socket.create_connection((address, port), timeout)
+        try:
+            tls_sock = ssl_context.wrap_socket(sock, server_hostname=address)
+            cert = tls_sock.getpeercert(binary_form=True)
+            tls_sock.close()
+        finally:
+            sock.close()
+    except socket.timeout:
+        raise
+    except (socket.error, ssl.SSLError, ssl.CertificateError) as e:
+        if verify:
+            message = 'Unable to verify certificate for %s: %s'
+        else:
+            message = 'Unable to get certificate for %s: %s'
+        return (types.STATE_CRITICAL.code,
+                'SSL CRITICAL - ' + message % (address, e))
+    if not cert:
+        return (types.STATE_CRITICAL.code,
+                'SSL CRITICAL - No certificate for %s.' % (address,))
+    expires = _cert_not_after(cert)
+    days_left = (expires - arrow.utcnow()).days
+    if days_left < 0:
+        state = types.STATE_CRITICAL
+        output = 'SSL CRITICAL - Certificate for %s expired on %s.' % (
+            address, expires)
+    else:
+        state = types.STATE_OK
+        if days_left < cert_days:
+            state = types.STATE_WARNING
+        output = ('SSL %s - Certificate for %s will expire in %d days '
+                  '(%s).' % (state.name.upper(), address, days_left,
+                             expires))
+    return state.code, output
+
+
+def check_tcp(context, timeout):
+    """ Checks that a TCP port accepts connections, and how quickly.
+
+    Context: address, port, warn_timeout, crit_timeout.
+    """
+    address = context['address']
+    port = int(context['port'])
+    start = time.time()
+    try:
+        sock = socket.create_connection((address, port), timeout)
+        sock.close()
+    except socket.timeout:
+        raise
+    except socket.error as e:
+        return (types.STATE_CRITICAL.code,
+                'TCP CRITICAL - Unable to connect to %s port %d: %s' % (
+                    address, port, e))
+    elapsed = time.time() - start
+    state = _state(context, elapsed)
+    output = 'TCP %s - %.3f second response time on %s port %d|%s' % (
+        state.name.upper(), elapsed, address, port,
+        _time_perfdata(context, elapsed))
+    return state.code, output
+
+
+def check_file(context, timeout):
+    """ Checks that a regular file exists.
+
+    Context: file_name.
+    """
+    file_name = context['file_name']
+    if os.path.isfile(file_name):
+        return types.STATE_OK.code, 'FILE OK - %s exists.' % (file_name,)
+    return (types.STATE_CRITICAL.code,
+            'FILE CRITICAL - %s does not exist.' % (file_name,))
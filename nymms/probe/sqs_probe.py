@@ -1,28 +1,109 @@
+import collections
 import logging
 import json
+import math
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
+from boto.exception import SQSError
 from boto.sqs.message import Message
 
-from nymms.schemas import Task
+from nymms.schemas import Task, codec
 from nymms.probe.Probe import Probe
 from nymms.state.sdb_state import SDBStateManager
 from nymms.utils.aws_helper import SNSTopic, ConnectionManager
 
 
+# The most messages SQS will hand out or delete in a single request.
+MAX_BATCH_SIZE = 10
+# Keep batched results comfortably below the 256KB SNS message limit.
+MAX_RESULT_BATCH_BYTES = 200 * 1024
+
+
+def _by_queue(messages):
+    """ Groups messages by the queue they were received from, preserving
+    their order.
+    """
+    groups = collections.OrderedDict()
+    for message in messages:
+        groups.setdefault(message.queue, []).append(message)
+    return groups.items()
+
+
 class SQSProbe(Probe):
+    """ A probe that takes its tasks from one or more SQS queues.
+
+    task_queue can be a single queue name or a list of them (say the default
+    tasks queue plus a few realm queues).  With more than one queue each
+    receive first short polls the queues, in an order picked by smooth
+    weighted round robin using queue_weights (a dict of queue name ->
+    weight, defaulting to 1), and takes tasks from the first queue that has
+    any.  Only when every queue is empty does it long poll, and then the
+    wait is split between the queues so that a busy queue is never stuck
+    behind a long poll on an idle one.
+
+    Resubmitted tasks and results are encoded with message_codec, and
+    compressed if they're larger than compress_threshold bytes (see
+    nymms.schemas.codec).  Tasks written with any codec can be read.
+    """
     def __init__(self, region, task_queue, results_topic, state_domain,
-                 state_manager=SDBStateManager):
+                 state_manager=SDBStateManager, receive_batch_size=1,
+                 delete_batch_size=1, result_batch_size=1,
+                 result_batch_time=1000, visibility_timeout=None,
+                 heartbeat_interval=10, queue_weights=None,
+                 message_codec=None, compress_threshold=0):
         self.region = region
-        self.queue_name = task_queue
+        self.codec = codec.get_codec(message_codec)
+        self.compress_threshold = compress_threshold
+        if isinstance(task_queue, basestring):
+            task_queue = [task_queue]
+        self.queue_names = list(task_queue)
+        self.queue_name = self.queue_names[0]
+        queue_weights = queue_weights or {}
+        self.queue_weights = [queue_weights.get(name, 1)
+                              for name in self.queue_names]
+        # The current credit of each queue in the weighted round robin
+        self._queue_credits = [0] * len(self.queue_names)
         self.topic_name = results_topic
         self.state_manager = state_manager(region, state_domain)
+        self.receive_batch_size = min(receive_batch_size, MAX_BATCH_SIZE)
+        self.delete_batch_size = min(delete_batch_size, MAX_BATCH_SIZE)
+        self.result_batch_size = result_batch_size
+        # milliseconds
+        self.result_batch_time = result_batch_time
+        # If set, tasks are received with this (short) visibility timeout
+        # which is then extended every heartbeat_interval seconds for as
+        # long as the task is in the probe.
+        self.visibility_timeout = visibility_timeout
+        self.heartbeat_interval = heartbeat_interval
 
         self._conn = None
-        self._queue = None
+        self._queues = None
         self._topic = None
 
+        # Messages that have been received but not yet handed to a worker
+        self._task_buffer = collections.deque()
+        self._task_buffer_lock = threading.Lock()
+        # Messages for finished tasks that are waiting to be deleted
+        self._pending_deletes = []
+        self._pending_deletes_lock = threading.Lock()
+        # Encoded results waiting to be published together, along with the
+        # messages of their tasks, which aren't deleted until the batch has
+        # been published.
+        self._result_batch = []
+        self._result_batch_bytes = 0
+        self._unpublished = set()
+        self._deferred_deletes = set()
+        self._result_batch_timer = None
+        self._result_batch_lock = threading.Lock()
+        # Messages that haven't been deleted yet, keyed on receipt handle,
+        # along with when their visibility timeout runs out.
+        self._leases = {}
+        self._leases_lock = threading.Lock()
+        self._heartbeat = None
+
         super(SQSProbe, self).__init__()
 
     @property
@@ -31,11 +112,28 @@ class SQSProbe(Probe):
             self._conn = ConnectionManager(self.region)
         return self._conn
 
+    @property
+    def queues(self):
+        if not self._queues:
+            self._queues = [self.conn.sqs.create_queue(name)
+                            for name in self.queue_names]
+        return self._queues
+
     @property
     def queue(self):
-        if not self._queue:
-            self._queue = self.conn.sqs.create_queue(self.queue_name)
-        return self._queue
+        return self.queues[0]
+
+    def _poll_order(self):
+        """ Returns the indexes of the queues in the order they should be
+        polled, using smooth weighted round robin to pick the first one.
+        Over time each queue goes first in proportion to its weight.
+        """
+        credits = self._queue_credits
+        for i, weight in enumerate(self.queue_weights):
+            credits[i] += weight
+        order = sorted(range(len(credits)), key=lambda i: -credits[i])
+        credits[order[0]] -= sum(self.queue_weights)
+        return order
 
     @property
     def topic(self):
@@ -43,29 +141,263 @@ class SQSProbe(Probe):
             self._topic = SNSTopic(self.region, self.topic_name)
         return self._topic
 
-    def get_task(self, **kwargs):
+    def _receive_tasks(self, **kwargs):
         wait_time = kwargs.get('queue_wait_time')
-        timeout = kwargs.get('monitor_timeout') + 3
-        logger.debug("Getting task from queue %s.", self.queue_name)
-        task_item = self.queue.read(visibility_timeout=timeout,
-                                    wait_time_seconds=wait_time)
-        task = None
-        if task_item:
-            task = Task(json.loads(task_item.get_body()), origin=task_item)
-        return task
+        if self.visibility_timeout:
+            self.start_heartbeat()
+            timeout = self.visibility_timeout
+        else:
+            concurrency = kwargs.get('concurrency') or 1
+            # Tasks received in a batch can sit in the buffer while earlier
+            # tasks in the batch run, so the visibility timeout has to cover
+            # every round of tasks it takes the workers to get through it.
+            rounds = int(math.ceil(float(self.receive_batch_size) /
+                                   concurrency))
+            timeout = (kwargs.get('monitor_timeout') + 3) * rounds
+        messages = self._poll_queues(timeout, wait_time)
+        if self.visibility_timeout:
+            expires = time.time() + timeout
+            with self._leases_lock:
+                for message in messages:
+                    self._leases[message.receipt_handle] = (message, expires)
+        return messages
+
+    def _get_messages(self, index, visibility_timeout, wait_time):
+        logger.debug("Getting up to %d tasks from queue %s.",
+                     self.receive_batch_size, self.queue_names[index])
+        return self.queues[index].get_messages(
+            num_messages=self.receive_batch_size,
+            visibility_timeout=visibility_timeout,
+            wait_time_seconds=wait_time)
+
+    def _poll_queues(self, visibility_timeout, wait_time):
+        if len(self.queue_names) == 1:
+            return self._get_messages(0, visibility_timeout, wait_time)
+        order = self._poll_order()
+        for index in order:
+            messages = self._get_messages(index, visibility_timeout, 0)
+            if messages:
+                return messages
+        if not wait_time:
+            return []
+        # Everything is empty, so wait for work - but only for a share of
+        # the wait time on each queue before checking the others again.
+        wait_time = max(wait_time // len(order), 1)
+        for index in order:
+            messages = self._get_messages(index, visibility_timeout,
+                                          wait_time)
+            if messages:
+                return messages
+        return []
+
+    def start_heartbeat(self):
+        if self._heartbeat:
+            return
+        self._heartbeat = threading.Thread(target=self._heartbeat_loop,
+                                           name='probe-heartbeat')
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self.extend_leases()
+            except Exception:
+                logger.exception("Unable to extend task visibility:")
+
+    def extend_leases(self):
+        """ Extends the visibility timeout of every task that would otherwise
+        become visible again before the next heartbeat has a chance to
+        extend it.
+        """
+        now = time.time()
+        cutoff = now + (2 * self.heartbeat_interval)
+        with self._leases_lock:
+            due = [message for message, expires in self._leases.values()
+                   if expires < cutoff]
+        for queue, messages in _by_queue(due):
+            for i in range(0, len(messages), MAX_BATCH_SIZE):
+                self._extend_leases(queue, messages[i:i + MAX_BATCH_SIZE],
+                                    now)
+
+    def _extend_leases(self, queue, batch, now):
+        logger.debug("Extending visibility of %d tasks by %d seconds.",
+                     len(batch), self.visibility_timeout)
+        response = queue.change_message_visibility_batch(
+            [(message, self.visibility_timeout) for message in batch])
+        failed = set(error['id'] for error in response.errors)
+        for error in response.errors:
+            logger.warning("Unable to extend visibility of task message "
+                           "%s: %s", error['id'], error.get('error_message'))
+        expires = now + self.visibility_timeout
+        with self._leases_lock:
+            for message in batch:
+                if (message.id not in failed and
+                        message.receipt_handle in self._leases):
+                    self._leases[message.receipt_handle] = (message,
+                                                            expires)
+
+    def _release_leases(self, messages):
+        with self._leases_lock:
+            for message in messages:
+                self._leases.pop(message.receipt_handle, None)
+
+    def encode(self, model):
+        return codec.compress(self.codec.encode(model),
+                              self.compress_threshold)
+
+    def get_task(self, **kwargs):
+        with self._task_buffer_lock:
+            if not self._task_buffer:
+                # Don't leave finished tasks waiting on a long poll.
+                self.flush_deletes()
+                self._task_buffer.extend(self._receive_tasks(**kwargs))
+            if not self._task_buffer:
+                return None
+            task_item = self._task_buffer.popleft()
+        return Task(codec.decode(task_item.get_body()), origin=task_item)
 
     def resubmit_task(self, task, delay, **kwargs):
         task.increment_attempt()
         logger.debug("Resubmitting task %s with %d second delay.", task.id,
                      delay)
         m = Message()
-        m.set_body(json.dumps(task.serialize()))
-        return self.queue.write(m, delay_seconds=delay)
+        m.set_body(self.encode(task))
+        # Send it back to the queue it came from
+        queue = getattr(task._origin, 'queue', None) or self.queue
+        return queue.write(m, delay_seconds=delay)
 
     def submit_result(self, result, **kwargs):
         logger.debug("%s - submitting '%s/%s' result", result.id,
                      result.state.name, result.state_type.name)
-        return self.topic.publish(json.dumps(result.to_primitive()))
+        encoded_result = self.encode(result)
+        if self.result_batch_size <= 1:
+            return self.topic.publish(encoded_result)
+        if codec.HEADER_RE.match(encoded_result):
+            # Anything but plain JSON is an opaque string, which is carried
+            # in the batch as a JSON string.
+            encoded_result = json.dumps(encoded_result)
+        with self._result_batch_lock:
+            if (self._result_batch_bytes + len(encoded_result) >
+                    MAX_RESULT_BATCH_BYTES):
+                self._flush_results()
+            self._result_batch.append((encoded_result, result._origin))
+            self._result_batch_bytes += len(encoded_result)
+            if result._origin is not None:
+                self._unpublished.add(result._origin)
+            if len(self._result_batch) >= self.result_batch_size:
+                self._flush_results()
+            elif not self._result_batch_timer:
+                self._start_result_timer()
+
+    def _start_result_timer(self):
+        self._result_batch_timer = threading.Timer(
+            self.result_batch_time / 1000.0, self._timed_flush_results)
+        self._result_batch_timer.daemon = True
+        self._result_batch_timer.start()
+
+    def _timed_flush_results(self):
+        with self._result_batch_lock:
+            try:
+                self._flush_results()
+            except Exception:
+                logger.exception("Unable to publish %d results, will try "
+                                 "again:", len(self._result_batch))
+                self._start_result_timer()
+
+    def flush_results(self):
+        with self._result_batch_lock:
+            self._flush_results()
+
+    def _flush_results(self):
+        if self._result_batch_timer:
+            self._result_batch_timer.cancel()
+            self._result_batch_timer = None
+        if not self._result_batch:
+            return
+        logger.debug("Publishing batch of %d results.",
+                     len(self._result_batch))
+        # The results are already encoded, so build the envelope by hand
+        # rather than decoding and re-encoding each of them.
+        message = '{"results": [%s]}' % (
+            ', '.join(encoded for encoded, origin in self._result_batch),)
+        self.topic.publish(message)
+        # Only forget the results once they're published, and only then
+        # delete their tasks.
+        published = [origin for encoded, origin in self._result_batch
+                     if origin is not None]
+        self._result_batch = []
+        self._result_batch_bytes = 0
+        for origin in published:
+            self._unpublished.discard(origin)
+            if origin in self._deferred_deletes:
+                self._deferred_deletes.discard(origin)
+                self._delete_message(origin)
 
     def delete_task(self, task):
-        self.queue.delete_message(task._origin)
+        with self._result_batch_lock:
+            if task._origin in self._unpublished:
+                # Deleted once the task's result has been published
+                self._deferred_deletes.add(task._origin)
+                return
+            self._delete_message(task._origin)
+
+    def release_task(self, task, delay):
+        message = task._origin
+        # Stop the heartbeat from keeping it invisible
+        self._release_leases([message])
+        logger.debug("Releasing task %s for %d seconds.", task.id, delay)
+        try:
+            message.change_visibility(delay)
+        except SQSError as e:
+            # It'll become visible once its visibility timeout runs out
+            logger.error("Unable to release task %s: %s", task.id, e)
+
+    def _delete_message(self, message):
+        with self._pending_deletes_lock:
+            self._pending_deletes.append(message)
+            # If there are still buffered tasks then get_task won't be
+            # hitting SQS soon, so hold on to the delete until the batch
+            # fills up.
+            if (len(self._pending_deletes) >= self.delete_batch_size or
+                    not self._task_buffer):
+                self._flush_deletes()
+
+    def run(self, **kwargs):
+        try:
+            return super(SQSProbe, self).run(**kwargs)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """ Publishes any batched results, and deletes their tasks. """
+        try:
+            self.flush_results()
+        except Exception:
+            logger.exception("Unable to publish %d results on exit:",
+                             len(self._result_batch))
+        self.flush_deletes()
+
+    def flush_deletes(self):
+        with self._pending_deletes_lock:
+            self._flush_deletes()
+
+    def _flush_deletes(self):
+        pending = self._pending_deletes
+        self._pending_deletes = []
+        self._release_leases(pending)
+        for queue, messages in _by_queue(pending):
+            for i in range(0, len(messages), MAX_BATCH_SIZE):
+                self._delete_messages(queue, messages[i:i + MAX_BATCH_SIZE])
+
+    def _delete_messages(self, queue, batch):
+        if len(batch) == 1:
+            queue.delete_message(batch[0])
+            return
+        logger.debug("Deleting %d tasks from queue %s.", len(batch),
+                     queue.name)
+        response = queue.delete_message_batch(batch)
+        for error in response.errors:
+            logger.error("Unable to delete task message %s: %s",
+                         error['id'], error.get('error_message'))
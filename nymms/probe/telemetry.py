@@ -0,0 +1,171 @@
+""" In-process timing telemetry for the checks a probe runs.
+
+Every task the probe executes produces a sample: the wall time of the
+check, how long the task sat in the queue before the probe got to it, the
+user & system cpu time of the check's process and whether it timed out.
+Samples are aggregated per monitor and per node into histograms, which the
+probe logs periodically so that the monitors using up the most probe
+capacity are easy to find.
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the histogram buckets.  Anything larger than
+# the last bound lands in an overflow bucket.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 25.0, 60.0, 300.0)
+
+METRICS = ('wall_time', 'queue_wait', 'cpu_user', 'cpu_system')
+
+
+class Histogram(object):
+    """ Counts observations in fixed buckets, along with their count, total
+    and max.  Percentiles are estimated from the bucket bounds.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """ Returns the upper bound of the bucket holding the given
+        percentile (or the max, if that's smaller).
+        """
+        if not self.count:
+            return 0.0
+        target = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                if i < len(self.buckets):
+                    return min(self.buckets[i], self.max)
+                break
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'mean': self.mean, 'p50': self.percentile(50),
+                'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+
+class Stats(object):
+    """ The histograms of every metric, plus a count of timeouts, for one
+    monitor or node.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.histograms = dict((m, Histogram(buckets)) for m in METRICS)
+        self.timeouts = 0
+
+    @property
+    def runs(self):
+        return self.histograms['wall_time'].count
+
+    def add(self, sample):
+        for metric, histogram in self.histograms.iteritems():
+            value = sample.get(metric)
+            if value is not None:
+                histogram.observe(value)
+        if sample.get('timed_out'):
+            self.timeouts += 1
+
+    def to_dict(self):
+        d = dict((m, h.to_dict()) for m, h in self.histograms.iteritems())
+        d['runs'] = self.runs
+        d['timeouts'] = self.timeouts
+        return d
+
+
+class Telemetry(object):
+    """ Thread-safe collection of check samples, aggregated per monitor and
+    per node.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.monitors = {}
+        self.nodes = {}
+        self.since = time.time()
+
+    def record(self, monitor, node, sample):
+        with self._lock:
+            for stats, key in ((self.monitors, monitor), (self.nodes, node)):
+                if key not in stats:
+                    stats[key] = Stats(self.buckets)
+                stats[key].add(sample)
+
+    def snapshot(self, reset=False):
+        """ Returns the current aggregates as plain dictionaries, optionally
+        starting over afterwards.
+        """
+        with self._lock:
+            snapshot = {
+                'since': self.since,
+                'monitors': dict((k, v.to_dict())
+                                 for k, v in self.monitors.iteritems()),
+                'nodes': dict((k, v.to_dict())
+                              for k, v in self.nodes.iteritems())}
+            if reset:
+                self._reset()
+        return snapshot
+
+    def log_summary(self, top=10, reset=True):
+        """ Logs the monitors and nodes that used the most check time since
+        the last summary.
+        """
+        snapshot = self.snapshot(reset=reset)
+        period = time.time() - snapshot['since']
+        for kind in ('monitors', 'nodes'):
+            stats = snapshot[kind]
+            busiest = sorted(stats.iteritems(),
+                             key=lambda i: i[1]['wall_time']['total'],
+                             reverse=True)[:top]
+            for name, s in busiest:
+                logger.info(
+                    "Telemetry (%ds) %s %s: runs %d, timeouts %d, wall "
+                    "%.3fs total %.3fs p50 %.3fs p90 %.3fs p99, queue wait "
+                    "%.3fs p90, cpu %.3fs user %.3fs sys.", period, kind[:-1],
+                    name, s['runs'], s['timeouts'], s['wall_time']['total'],
+                    s['wall_time']['p50'], s['wall_time']['p90'],
+                    s['wall_time']['p99'], s['queue_wait']['p90'],
+                    s['cpu_user']['total'], s['cpu_system']['total'])
+        return snapshot
+
+    def start_reporter(self, interval):
+        """ Starts a daemon thread that calls log_summary every interval
+        seconds.
+        """
+        def report():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.log_summary()
+                except Exception:
+                    logger.exception("Unable to log telemetry summary:")
+
+        reporter = threading.Thread(target=report, name='probe-telemetry')
+        reporter.daemon = True
+        reporter.start()
+        return reporter
@@ -0,0 +1,137 @@
+import unittest
+import os
+import socket
+import ssl
+import tempfile
+import threading
+import BaseHTTPServer
+
+from nymms.probe import checks
+from nymms.schemas import types
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_CERT = os.path.join(TEST_DIR, 'test_cert.pem')
+TEST_KEY = os.path.join(TEST_DIR, 'test_cert.key')
+
+
+class DummyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        status = int(self.path.strip('/') or 200)
+        body = 'status %d' % (status,)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DummyServer(BaseHTTPServer.HTTPServer):
+    def handle_error(self, request, client_address):
+        # Failed TLS handshakes are expected, don't print them
+        pass
+
+
+def start_server(use_ssl=False):
+    server = DummyServer(('127.0.0.1', 0), DummyHandler)
+    if use_ssl:
+        server.socket = ssl.wrap_socket(server.socket, certfile=TEST_CERT,
+                                        keyfile=TEST_KEY, server_side=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class TestHTTPChecks(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = start_server()
+        cls.ssl_server = start_server(use_ssl=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.ssl_server.shutdown()
+
+    def make_context(self, server, **kwargs):
+        context = {'address': '127.0.0.1', 'port': server.server_port,
+                   'warn_timeout': 1, 'crit_timeout': 10}
+        context.update(kwargs)
+        return context
+
+    def test_check_http(self):
+        code, output = checks.check_http(self.make_context(self.server), 5)
+        self.assertEqual(code, types.STATE_OK.code)
+        self.assertTrue(output.startswith('HTTP OK: HTTP/1.1 200 OK'))
+        self.assertIn('|time=', output)
+
+    def test_check_http_status(self):
+        context = self.make_context(self.server, url='/404')
+        code, _ = checks.check_http(context, 5)
+        self.assertEqual(code, types.STATE_WARNING.code)
+        context = self.make_context(self.server, url='/503')
+        code, _ = checks.check_http(context, 5)
+        self.assertEqual(code, types.STATE_CRITICAL.code)
+
+    def test_check_http_minimum_size(self):
+        context = self.make_context(self.server, minimum_size=1000)
+        code, _ = checks.check_http(context, 5)
+        self.assertEqual(code, types.STATE_WARNING.code)
+
+    def test_check_https(self):
+        context = self.make_context(self.ssl_server)
+        code, output = checks.check_https(context, 5)
+        self.assertEqual(code, types.STATE_OK.code)
+        self.assertTrue(output.startswith('HTTPS OK'))
+
+    def test_check_cert(self):
+        context = self.make_context(self.ssl_server, address='localhost',
+                                    ca_file=TEST_CERT, cert_days=30)
+        code, output = checks.check_cert(context, 5)
+        self.assertEqual(code, types.STATE_OK.code, output)
+        context['cert_days'] = 365 * 200
+        code, output = checks.check_cert(context, 5)
+        self.assertEqual(code, types.STATE_WARNING.code, output)
+
+    def test_check_cert_unverified(self):
+        # The self-signed certificate's expiry is checked without verifying
+        context = self.make_context(self.ssl_server, cert_days=30)
+        code, output = checks.check_cert(context, 5)
+        self.assertEqual(code, types.STATE_OK.code, output)
+        context['verify'] = True
+        code, output = checks.check_cert(context, 5)
+        self.assertEqual(code, types.STATE_CRITICAL.code)
+        self.assertIn('Unable to verify', output)
+
+    def test_cert_not_after(self):
+        with open(TEST_CERT) as f:
+            der = ssl.PEM_cert_to_DER_cert(f.read())
+        expected = ssl.cert_time_to_seconds(
+            ssl._ssl._test_decode_cert(TEST_CERT)['notAfter'])
+        self.assertEqual(checks._cert_not_after(der).timestamp, expected)
+
+
+class TestTCPCheck(unittest.TestCase):
+    def test_check_tcp(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        port = listener.getsockname()[1]
+        code, output = checks.check_tcp({'address': '127.0.0.1',
+                                         'port': port}, 5)
+        self.assertEqual(code, types.STATE_OK.code)
+        listener.close()
+        code, output = checks.check_tcp({'address': '127.0.0.1',
+                                         'port': port}, 5)
+        self.assertEqual(code, types.STATE_CRITICAL.code)
+
+
+class TestFileCheck(unittest.TestCase):
+    def test_check_file(self):
+        with tempfile.NamedTemporaryFile() as f:
+            code, _ = checks.check_file({'file_name': f.name}, 5)
+            self.assertEqual(code, types.STATE_OK.code)
+        code, _ = checks.check_file({'file_name': f.name}, 5)
+        self.assertEqual(code, types.STATE_CRITICAL.code)
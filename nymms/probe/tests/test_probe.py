@@ -8,6 +8,8 @@ from nymms.probe.Probe import Probe, TIMEOUT_OUTPUT
 from nymms.schemas import types, Result, Task, StateRecord
 from nymms import resources
 from nymms.state.State import StateManager
+from nymms.utils.cache import LRUCache
+from nymms.probe.telemetry import Telemetry
 
 import arrow
 
@@ -33,6 +35,9 @@ true_monitor = resources.Monitor('true_monitor', command=true_command)
 fail_monitor = resources.Monitor('fail_monitor', command=fail_command)
 sleep_monitor = resources.Monitor('sleep_monitor', command=sleep_command)
 
+compact_group = resources.MonitoringGroup('probe_compact_mg',
+                                          group_attr='group')
+
 
 class DummyStateBackend(object):
     def __init__(self):
@@ -146,6 +151,32 @@ class TestStateChange(unittest.TestCase):
         self.assertTrue(self.probe.expire_task(t, expiration))
 
 
+class TestCachedStateChange(unittest.TestCase):
+    def setUp(self):
+        self.probe = DummyProbe()
+        self.probe.state_cache = LRUCache(10, 60)
+        self.backend = self.probe.state_manager.backend
+        self.backend_calls = 0
+        backend_get = self.backend.get
+
+        def counting_get(*args, **kwargs):
+            self.backend_calls += 1
+            return backend_get(*args, **kwargs)
+        self.backend.get = counting_get
+
+    def test_state_change(self):
+        t = self.probe.get_task()
+        for i, code in enumerate(result_codes):
+            r = self.probe.handle_task(t, monitor_timeout=30,
+                                       max_retries=2)
+            expected = self.backend.states[i + 1]
+            self.assertEqual(r.state, expected['state'])
+            self.assertEqual(r.state_type, expected['state_type'])
+            self.probe.submit_result(r)
+        # Only the first run of the task should need the backend
+        self.assertEqual(self.backend_calls, 1)
+
+
 class TestExecuteTask(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -177,3 +208,60 @@ class TestExecuteTask(unittest.TestCase):
         result = self.probe.execute_task(self.timeout_task, timeout)
         self.assertEqual(result.state, types.STATE_UNKNOWN)
         self.assertEqual(result.output.strip(), TIMEOUT_OUTPUT % timeout)
+
+    def test_execute_task_telemetry(self):
+        self.probe.telemetry = Telemetry()
+        try:
+            result = self.probe.execute_task(self.true_task, 30,
+                                             result_telemetry=True)
+            self.probe.execute_task(self.timeout_task, 1)
+            stats = self.probe.telemetry.snapshot()['monitors']
+        finally:
+            self.probe.telemetry = None
+        self.assertEqual(set(result.telemetry.keys()),
+                         set(['wall_time', 'queue_wait', 'cpu_user',
+                              'cpu_system']))
+        self.assertIn('telemetry', result.to_primitive())
+        self.assertEqual(stats['true_monitor']['runs'], 1)
+        self.assertEqual(stats['true_monitor']['timeouts'], 0)
+        self.assertEqual(stats['sleep_monitor']['timeouts'], 1)
+        self.assertGreaterEqual(stats['sleep_monitor']['wall_time']['max'], 1)
+
+    def test_execute_task_without_telemetry(self):
+        result = self.probe.execute_task(self.true_task, 30)
+        self.assertNotIn('telemetry', result.to_primitive())
+
+
+class TestCompactTask(unittest.TestCase):
+    def setUp(self):
+        self.probe = Probe()
+        self.probe.resources_version = 'v1'
+
+    def make_task(self, monitor, version='v1'):
+        return Task({
+            'id': 'www1:' + monitor,
+            'context': {'node': {'name': 'www1', 'address': '10.0.0.1'},
+                        'realm': None},
+            'reference': {'monitoringgroup': 'probe_compact_mg',
+                          'monitor': monitor, 'version': version}})
+
+    def test_expand_task(self):
+        task = self.make_task('true_monitor')
+        self.assertTrue(self.probe.expand_task(task))
+        self.assertIsNone(task.reference)
+        self.assertEqual(task.context['monitor']['name'], 'true_monitor')
+        self.assertEqual(task.context['address'], '10.0.0.1')
+        self.assertEqual(task.context['group_attr'], 'group')
+
+    def test_version_matches(self):
+        self.assertTrue(self.probe.version_matches(self.make_task(
+            'true_monitor')))
+        for i in range(2):
+            self.assertFalse(self.probe.version_matches(self.make_task(
+                'true_monitor', 'v0')))
+        self.assertEqual(self.probe._mismatched_versions, set(['v0']))
+
+    def test_missing_monitor(self):
+        task = self.make_task('missing_monitor')
+        self.assertFalse(self.probe.expand_task(task))
+        self.assertIsNone(self.probe.handle_task(task))
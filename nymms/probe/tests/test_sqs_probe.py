@@ -0,0 +1,352 @@
+import unittest
+import json
+import threading
+import time
+
+from nymms.probe.sqs_probe import SQSProbe
+from nymms.schemas import Task, Result, types, codec
+
+
+class DummyStateManager(object):
+    def __init__(self, region, domain):
+        pass
+
+
+class DummyMessage(object):
+    def __init__(self, body):
+        self.body = body
+        self.id = self.receipt_handle = str(id(self))
+        self.visibility_changes = []
+
+    def get_body(self):
+        return self.body
+
+    def change_visibility(self, visibility_timeout):
+        self.visibility_changes.append(visibility_timeout)
+
+
+class DummyBatchResults(object):
+    errors = []
+
+
+class DummyQueue(object):
+    def __init__(self, messages, name='tasks'):
+        self.name = name
+        self.messages = list(messages)
+        self.receive_calls = 0
+        self.deleted = []
+        self.delete_calls = 0
+        self.visibility_changes = []
+        self.wait_times = []
+        self.written = []
+
+    def get_messages(self, num_messages=1, visibility_timeout=None,
+                     wait_time_seconds=None):
+        self.receive_calls += 1
+        self.wait_times.append(wait_time_seconds)
+        messages = self.messages[:num_messages]
+        del self.messages[:num_messages]
+        for message in messages:
+            message.queue = self
+        return messages
+
+    def delete_message(self, message):
+        self.delete_calls += 1
+        self.deleted.append(message)
+
+    def delete_message_batch(self, messages):
+        self.delete_calls += 1
+        self.deleted.extend(messages)
+        return DummyBatchResults()
+
+    def change_message_visibility_batch(self, messages):
+        self.visibility_changes.extend(messages)
+        return DummyBatchResults()
+
+    def write(self, message, delay_seconds=None):
+        self.written.append(message)
+
+
+def make_message(task_id):
+    return DummyMessage(json.dumps(Task({'id': task_id}).to_primitive()))
+
+
+class TestSQSProbeBatching(unittest.TestCase):
+    def setUp(self):
+        self.messages = [make_message('test:%d' % i) for i in range(15)]
+        self.probe = SQSProbe('us-east-1', 'tasks', 'results', 'state',
+                              state_manager=DummyStateManager,
+                              receive_batch_size=10, delete_batch_size=10)
+        self.probe._queues = [DummyQueue(self.messages)]
+
+    def test_batched_receive_and_delete(self):
+        task_ids = []
+        while True:
+            task = self.probe.get_task(monitor_timeout=30)
+            if not task:
+                break
+            task_ids.append(task.id)
+            self.probe.delete_task(task)
+        queue = self.probe.queue
+        self.assertEqual(task_ids, ['test:%d' % i for i in range(15)])
+        # two full receives, then one that comes back empty
+        self.assertEqual(queue.receive_calls, 3)
+        self.assertEqual(queue.deleted, self.messages)
+        self.assertEqual(queue.delete_calls, 2)
+
+    def test_deletes_flushed_when_buffer_empty(self):
+        self.probe._queues = [DummyQueue(self.messages[:1])]
+        task = self.probe.get_task(monitor_timeout=30)
+        self.probe.delete_task(task)
+        self.assertEqual(self.probe.queue.deleted, self.messages[:1])
+
+
+class TestSQSProbeMultiQueue(unittest.TestCase):
+    def setUp(self):
+        self.probe = SQSProbe('us-east-1', ['tasks', 'tasks_REALM_a'],
+                              'results', 'state',
+                              state_manager=DummyStateManager,
+                              receive_batch_size=10, delete_batch_size=10,
+                              queue_weights={'tasks': 2})
+        self.default = DummyQueue([], name='tasks')
+        self.realm = DummyQueue([make_message('realm:%d' % i)
+                                 for i in range(2)], name='tasks_REALM_a')
+        self.probe._queues = [self.default, self.realm]
+
+    def test_poll_order(self):
+        firsts = [self.probe._poll_order()[0] for i in range(6)]
+        self.assertEqual(firsts, [0, 1, 0, 0, 1, 0])
+
+    def test_takes_from_queue_with_backlog(self):
+        task = self.probe.get_task(monitor_timeout=30, queue_wait_time=20)
+        self.assertEqual(task.id, 'realm:0')
+        # No long polls while a queue has tasks
+        self.assertEqual(self.default.wait_times, [0])
+        self.assertEqual(self.realm.wait_times, [0])
+        self.probe.resubmit_task(task, 0)
+        self.assertEqual(len(self.realm.written), 1)
+        self.probe.delete_task(task)
+        self.probe.delete_task(self.probe.get_task(monitor_timeout=30))
+        self.assertEqual(self.default.deleted, [])
+        self.assertEqual(len(self.realm.deleted), 2)
+
+    def test_long_poll_split_between_queues(self):
+        self.realm.messages = []
+        task = self.probe.get_task(monitor_timeout=30, queue_wait_time=20)
+        self.assertIs(task, None)
+        self.assertEqual(self.default.wait_times, [0, 10])
+        self.assertEqual(self.realm.wait_times, [0, 10])
+
+
+class TestSQSProbeHeartbeat(unittest.TestCase):
+    def setUp(self):
+        self.messages = [make_message('test:%d' % i) for i in range(2)]
+        self.probe = SQSProbe('us-east-1', 'tasks', 'results', 'state',
+                              state_manager=DummyStateManager,
+                              receive_batch_size=10, visibility_timeout=30,
+                              heartbeat_interval=10)
+        # Don't start the real heartbeat thread, extend_leases is called
+        # directly instead.
+        self.probe._heartbeat = True
+        self.probe._queues = [DummyQueue(self.messages)]
+
+    def test_extend_leases(self):
+        first = self.probe.get_task(monitor_timeout=30)
+        # Nothing expires before the heartbeat after next
+        self.probe.extend_leases()
+        self.assertEqual(self.probe.queue.visibility_changes, [])
+        for message, expires in self.probe._leases.values():
+            self.probe._leases[message.receipt_handle] = (message,
+                                                          time.time() + 5)
+        self.probe.extend_leases()
+        changes = self.probe.queue.visibility_changes
+        self.assertEqual(sorted(changes),
+                         sorted([(m, 30) for m in self.messages]))
+        # Deleted tasks aren't extended any more
+        self.probe.delete_task(first)
+        self.probe.flush_deletes()
+        self.assertEqual(self.probe._leases.keys(),
+                         [self.messages[1].receipt_handle])
+
+    def test_release_task(self):
+        task = self.probe.get_task(monitor_timeout=30)
+        self.probe.release_task(task, 10)
+        self.assertEqual(self.messages[0].visibility_changes, [10])
+        # The heartbeat leaves it alone from now on
+        self.assertNotIn(self.messages[0].receipt_handle, self.probe._leases)
+
+
+class DummyTopic(object):
+    def __init__(self, failures=0):
+        self.published = []
+        self.failures = failures
+
+    def publish(self, message):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("publish failed")
+        self.published.append(message)
+
+
+class TestSQSProbeResultBatching(unittest.TestCase):
+    def setUp(self):
+        self.probe = SQSProbe('us-east-1', 'tasks', 'results', 'state',
+                              state_manager=DummyStateManager,
+                              result_batch_size=3, result_batch_time=50)
+        self.probe._topic = DummyTopic()
+
+    def make_result(self, task_id):
+        return Result({'id': task_id, 'state': types.STATE_OK,
+                       'state_type': types.STATE_TYPE_HARD})
+
+    def test_batch_published_when_full(self):
+        for i in range(3):
+            self.probe.submit_result(self.make_result('test:%d' % i))
+        published = self.probe._topic.published
+        self.assertEqual(len(published), 1)
+        results = json.loads(published[0])['results']
+        self.assertEqual([r['id'] for r in results],
+                         ['test:0', 'test:1', 'test:2'])
+
+    def test_batch_published_after_batch_time(self):
+        self.probe.submit_result(self.make_result('test:0'))
+        self.assertEqual(self.probe._topic.published, [])
+        time.sleep(0.2)
+        published = self.probe._topic.published
+        self.assertEqual(len(published), 1)
+        self.assertEqual(len(json.loads(published[0])['results']), 1)
+
+    def test_compressed_results(self):
+        self.probe.compress_threshold = 1024
+        results = [self.make_result('test:0'), self.make_result('test:1')]
+        results[1].output = 'verbose output ' * 1000
+        for result in results + [self.make_result('test:2')]:
+            self.probe.submit_result(result)
+        batch = json.loads(self.probe._topic.published[0])['results']
+        # Only the large result is compressed
+        self.assertIsInstance(batch[0], dict)
+        self.assertTrue(batch[1].startswith('zlib.1:'))
+        self.assertLess(len(batch[1]), 1024)
+        self.assertEqual(Result(codec.decode(batch[1])).output,
+                         results[1].output)
+
+    def run_task(self, message):
+        """ Submits a result for a task and deletes it, as process_tasks
+        does.
+        """
+        message.queue = self.probe.queue
+        task = Task(json.loads(message.get_body()), origin=message)
+        self.probe.submit_result(Result(
+            {'id': task.id, 'state': types.STATE_OK,
+             'state_type': types.STATE_TYPE_HARD}, origin=task._origin))
+        self.probe.delete_task(task)
+
+    def test_tasks_deleted_after_publish(self):
+        messages = [make_message('test:%d' % i) for i in range(3)]
+        self.probe._queues = [DummyQueue([])]
+        for message in messages[:2]:
+            self.run_task(message)
+        # Nothing is deleted until the results have been published
+        self.assertEqual(self.probe.queue.deleted, [])
+        self.run_task(messages[2])
+        self.assertEqual(len(self.probe._topic.published), 1)
+        self.assertEqual(self.probe.queue.deleted, messages)
+
+    def test_failed_publish_kept(self):
+        message = make_message('test:0')
+        self.probe._queues = [DummyQueue([])]
+        self.probe._topic = DummyTopic(failures=1)
+        self.run_task(message)
+        # The first (timed) publish fails, the retry succeeds
+        time.sleep(0.3)
+        self.assertEqual(len(self.probe._topic.published), 1)
+        self.assertEqual(self.probe.queue.deleted, [message])
+
+    def test_flushed_on_exit(self):
+        message = make_message('test:0')
+        self.probe._queues = [DummyQueue([])]
+        self.probe.result_batch_time = 60000
+        self.run_task(message)
+        self.probe.shutdown()
+        self.assertEqual(len(self.probe._topic.published), 1)
+        self.assertEqual(self.probe.queue.deleted, [message])
+
+
+class StoppingQueue(DummyQueue):
+    """ Records any task that was deleted before its result was published,
+    and stops the probe's workers once every task has been deleted.
+    """
+    def __init__(self, messages, topic):
+        super(StoppingQueue, self).__init__(messages)
+        self.topic = topic
+        self.total = len(messages)
+        self.early_deletes = []
+
+    def get_messages(self, *args, **kwargs):
+        messages = super(StoppingQueue, self).get_messages(*args, **kwargs)
+        if not messages and len(self.deleted) == self.total:
+            # Quietly ends the worker thread, which stops the probe.
+            raise SystemExit()
+        return messages
+
+    def published_ids(self):
+        return set(r['id'] for batch in self.topic.published
+                   for r in json.loads(batch)['results'])
+
+    def check_published(self, messages):
+        published = self.published_ids()
+        for message in messages:
+            task_id = json.loads(message.get_body())['id']
+            if task_id not in published:
+                self.early_deletes.append(task_id)
+
+    def delete_message(self, message):
+        self.check_published([message])
+        return super(StoppingQueue, self).delete_message(message)
+
+    def delete_message_batch(self, messages):
+        self.check_published(messages)
+        return super(StoppingQueue, self).delete_message_batch(messages)
+
+
+class TestSQSProbeConcurrency(unittest.TestCase):
+    concurrency = 4
+
+    def setUp(self):
+        self.messages = [make_message('test:%d' % i)
+                         for i in range(self.concurrency)]
+        self.probe = SQSProbe('us-east-1', 'tasks', 'results', 'state',
+                              state_manager=DummyStateManager,
+                              receive_batch_size=10, delete_batch_size=10,
+                              result_batch_size=2)
+        self.probe._topic = DummyTopic()
+        self.queue = StoppingQueue(self.messages, self.probe._topic)
+        self.probe._queues = [self.queue]
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.lock = threading.Lock()
+        self.all_started = threading.Event()
+        self.probe.handle_task = self.handle_task
+
+    def handle_task(self, task, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+            if self.in_flight == self.concurrency:
+                self.all_started.set()
+        # Hold on to the task until every worker has one
+        self.all_started.wait(5)
+        with self.lock:
+            self.in_flight -= 1
+        return Result({'id': task.id, 'state': types.STATE_OK,
+                       'state_type': types.STATE_TYPE_HARD},
+                      origin=task._origin)
+
+    def test_concurrent_tasks(self):
+        with self.assertRaises(SystemExit):
+            self.probe.run(concurrency=self.concurrency, monitor_timeout=30)
+        self.assertEqual(self.most_in_flight, self.concurrency)
+        self.assertEqual(self.queue.published_ids(),
+                         set('test:%d' % i for i in range(self.concurrency)))
+        self.assertEqual(sorted(self.queue.deleted), sorted(self.messages))
+        self.assertEqual(self.queue.early_deletes, [])
@@ -0,0 +1,55 @@
+import unittest
+
+from nymms.probe.telemetry import Histogram, Telemetry
+
+
+class TestHistogram(unittest.TestCase):
+    def test_observe(self):
+        h = Histogram(buckets=(1, 2, 5))
+        for value in (0.5, 0.5, 1.5, 4, 10):
+            h.observe(value)
+        self.assertEqual(h.counts, [2, 1, 1, 1])
+        self.assertEqual(h.count, 5)
+        self.assertEqual(h.total, 16.5)
+        self.assertEqual(h.max, 10)
+        self.assertEqual(h.mean, 3.3)
+
+    def test_percentile(self):
+        h = Histogram(buckets=(1, 2, 5))
+        self.assertEqual(h.percentile(50), 0.0)
+        for value in (0.5, 0.5, 1.5, 4, 10):
+            h.observe(value)
+        self.assertEqual(h.percentile(40), 1)
+        self.assertEqual(h.percentile(60), 2)
+        self.assertEqual(h.percentile(99), 10)
+        h = Histogram(buckets=(1, 2, 5))
+        h.observe(0.25)
+        self.assertEqual(h.percentile(50), 0.25)
+
+
+class TestTelemetry(unittest.TestCase):
+    def sample(self, wall_time, timed_out=False):
+        return {'wall_time': wall_time, 'queue_wait': 0.1, 'cpu_user': None,
+                'cpu_system': None, 'timed_out': timed_out}
+
+    def test_record(self):
+        telemetry = Telemetry()
+        telemetry.record('check_a', 'www1', self.sample(1))
+        telemetry.record('check_a', 'www2', self.sample(2, timed_out=True))
+        telemetry.record('check_b', 'www1', self.sample(3))
+        snapshot = telemetry.snapshot()
+        self.assertEqual(snapshot['monitors']['check_a']['runs'], 2)
+        self.assertEqual(snapshot['monitors']['check_a']['timeouts'], 1)
+        self.assertEqual(
+            snapshot['monitors']['check_a']['wall_time']['total'], 3)
+        self.assertEqual(snapshot['monitors']['check_a']['cpu_user']['count'],
+                         0)
+        self.assertEqual(snapshot['nodes']['www1']['runs'], 2)
+        self.assertEqual(snapshot['nodes']['www1']['wall_time']['max'], 3)
+
+    def test_log_summary_resets(self):
+        telemetry = Telemetry()
+        telemetry.record('check_a', 'www1', self.sample(1))
+        snapshot = telemetry.log_summary()
+        self.assertIn('check_a', snapshot['monitors'])
+        self.assertEqual(telemetry.snapshot()['monitors'], {})
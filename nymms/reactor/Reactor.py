@@ -1,7 +1,11 @@
+import collections
 import logging
 import glob
 import os
 import sys
+import threading
+import time
+import Queue
 
 from nymms.daemon import NymmsDaemon
 from nymms.config import yaml_config
@@ -12,10 +16,26 @@ logger = logging.getLogger(__name__)
 
 
 class Reactor(NymmsDaemon):
+    """ Passes each result to every handler, then saves its new state.
+
+    If handler_workers (given to run) is greater than 1, then the handlers
+    for a result run at the same time in a pool of that many threads, so a
+    slow handler doesn't hold up the others.  The reactor waits at most
+    handler_timeout seconds (or the handler's own 'timeout' setting) for
+    each handler before saving the state and moving on to the next result.
+    A handler that timed out is left to finish in the background, and any
+    results that come in for it until it does are queued up and passed to
+    it in order once it's free.
+    """
     def __init__(self):
         self.handlers = {}
         self.suppression_manager = None
         self.state_manager = None
+        self._handler_jobs = None
+        # handler name -> the jobs waiting for that handler to finish its
+        # current one; a handler only has an entry while it's busy.
+        self._handler_pending = {}
+        self._handler_lock = threading.Lock()
 
         super(Reactor, self).__init__()
 
@@ -93,17 +113,91 @@ class Reactor(NymmsDaemon):
                          suppression_filter.created.isoformat())
         return suppression_filter
 
-    def handle_result(self, result, **kwargs):
-        previous_state = self.get_state(result.id)
-        for handler_name, handler in self.handlers.iteritems():
+    def run_handler(self, handler_name, handler, result, previous_state):
+        try:
+            # We do suppression AFTER filters, so we have to
+            # pass Reactor to the handler to do that for us
+            handler.process(result, previous_state, self.is_suppressed)
+        except Exception:
+            logutil.log_exception("Unhandled %s handler "
+                                  "exception:" % (handler_name,), logger)
+
+    def _start_handler_workers(self, count):
+        self._handler_jobs = Queue.Queue()
+        for i in range(count):
+            worker = threading.Thread(target=self._handler_worker,
+                                      name='reactor-handler-%d' % (i,))
+            worker.daemon = True
+            worker.start()
+
+    def _handler_worker(self):
+        while True:
+            handler_name, handler, result, previous_state, done = (
+                self._handler_jobs.get())
             try:
-                # We do suppression AFTER filters, so we have to
-                # pass Reactor to the handler to do that for us
-                handler.process(result, previous_state, self.is_suppressed)
-            except Exception:
-                logutil.log_exception("Unhandled %s handler "
-                                      "exception:" % (handler_name,), logger)
+                self.run_handler(handler_name, handler, result,
+                                 previous_state)
+            finally:
+                done.set()
+                self._next_handler_job(handler_name)
+
+    def _next_handler_job(self, handler_name):
+        with self._handler_lock:
+            pending = self._handler_pending[handler_name]
+            if pending:
+                self._handler_jobs.put(pending.popleft())
+            else:
+                del self._handler_pending[handler_name]
+
+    def _submit_handler_job(self, job):
+        """ Starts the job, or queues it up behind the handler's current
+        one so that each handler only runs one job at a time, in order.
+        """
+        handler_name = job[0]
+        with self._handler_lock:
+            pending = self._handler_pending.get(handler_name)
+            if pending is None:
+                self._handler_pending[handler_name] = collections.deque()
+                self._handler_jobs.put(job)
+                return
+            pending.append(job)
+            logger.warning("Handler %s is still busy with an earlier "
+                           "result, %d results (including %s) are waiting "
+                           "for it.", handler_name, len(pending), job[2].id)
+
+    def dispatch_handlers(self, result, previous_state, **kwargs):
+        """ Hands the result to every handler in the handler workers, and
+        waits until they've all finished or timed out.
+        """
+        if not self._handler_jobs:
+            self._start_handler_workers(kwargs.get('handler_workers'))
+        jobs = []
+        for handler_name, handler in self.handlers.iteritems():
+            done = threading.Event()
+            self._submit_handler_job((handler_name, handler, result,
+                                      previous_state, done))
+            jobs.append((handler_name, handler, done))
+        start = time.time()
+        for handler_name, handler, done in jobs:
+            timeout = (getattr(handler, 'timeout', None) or
+                       kwargs.get('handler_timeout'))
+            if not timeout:
+                done.wait()
                 continue
+            done.wait(max(start + timeout - time.time(), 0))
+            if not done.is_set():
+                logger.warning("Handler %s didn't finish with %s within %d "
+                               "seconds, moving on.", handler_name,
+                               result.id, timeout)
+
+    def handle_result(self, result, **kwargs):
+        previous_state = self.get_state(result.id)
+        if (kwargs.get('handler_workers') or 1) > 1:
+            self.dispatch_handlers(result, previous_state, **kwargs)
+        else:
+            for handler_name, handler in self.handlers.iteritems():
+                self.run_handler(handler_name, handler, result,
+                                 previous_state)
         try:
             self.save_state(result.id, result, previous_state)
         except OutOfDateState:
@@ -1,5 +1,7 @@
+import collections
 import logging
 import json
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -7,24 +9,59 @@ from nymms.reactor.Reactor import Reactor
 from nymms.suppress.sdb_suppress import SDBSuppressionManager
 from nymms.utils.aws_helper import SNSTopic, ConnectionManager
 from nymms.state.sdb_state import SDBStateManager
-from nymms.schemas import Result
+from nymms.schemas import Result, codec
 
+from boto.exception import SQSError
 from boto.sqs.message import RawMessage
 
 
+# The most messages SQS will hand out or delete in a single request.
+MAX_BATCH_SIZE = 10
+
+
 class AWSReactor(Reactor):
+    """ A reactor that reads results from an SQS queue subscribed to the
+    results topic.
+
+    Up to receive_batch_size messages are read at a time and buffered
+    locally, and handled messages are deleted delete_batch_size at a time.
+    Every message is received with the visibility_timeout given to
+    get_result, and each time get_result is called any message the reactor
+    still holds (buffered, being handled or waiting to be deleted) with
+    less than half of that left is given more time, or deleted straight
+    away if it's only waiting to be deleted.  That way messages held by a
+    reactor that dies are handed out again quickly, while the ones waiting
+    their turn don't become visible to another reactor.
+    """
     def __init__(self, region, topic_name, state_domain_name, queue_name,
                  suppress_domain_name, suppress_cache_timeout=60,
                  state_manager=SDBStateManager,
-                 suppression_manager=SDBSuppressionManager):
+                 suppression_manager=SDBSuppressionManager,
+                 receive_batch_size=1, delete_batch_size=1):
         super(AWSReactor, self).__init__()
         self.region = region
         self.topic_name = topic_name
         self.queue_name = queue_name
+        self.receive_batch_size = min(receive_batch_size, MAX_BATCH_SIZE)
+        self.delete_batch_size = min(delete_batch_size, MAX_BATCH_SIZE)
 
         self._conn = None
         self._queue = None
 
+        # Messages that have been received but not yet decoded.
+        self._message_buffer = collections.deque()
+        # Results that have been read off the queue but not yet returned by
+        # get_result, and how many results from each message still need to
+        # be handled before the message can be deleted.
+        self._result_buffer = collections.deque()
+        self._unhandled_results = {}
+        # Messages whose results have all been handled, waiting to be
+        # deleted.
+        self._pending_deletes = []
+        # Every message that hasn't been deleted or given up on yet, keyed
+        # on message id, along with when its visibility timeout runs out.
+        self._leases = {}
+
         self.state_manager = state_manager(region, state_domain_name)
         self.suppression_manager = suppression_manager(region,
                                                        suppress_cache_timeout,
@@ -45,30 +82,151 @@ class AWSReactor(Reactor):
             topic.subscribe_sqs_queue(self.queue)
         return self._queue
 
-    def get_result(self, **kwargs):
-        wait_time = kwargs.get('wait_time', 0)
-        visibility_timeout = kwargs.get('visibility_timeout', None)
+    def decode_results(self, message):
+        """ Returns the list of Results carried in a queue message.
 
-        logger.debug("Getting result from queue %s.", self.queue_name)
-        result = self.queue.read(visibility_timeout=visibility_timeout,
-                                 wait_time_seconds=wait_time)
-        result_obj = None
-        if result:
-            result_message = json.loads(result.get_body())['Message']
-            result_dict = json.loads(result_message)
+        Probes publish either a single result, or a batch of them in the
+        form {"results": [<result>, ...]}, where each result is either a
+        JSON object or a string encoded by another codec (see
+        nymms.schemas.codec).
+        """
+        result_message = json.loads(message.get_body())['Message']
+        result_data = codec.decode(result_message)
+        if 'results' in result_data:
+            result_dicts = [codec.decode(r) if isinstance(r, basestring)
+                            else r for r in result_data['results']]
+        else:
+            result_dicts = [result_data]
+        results = []
+        for result_dict in result_dicts:
             # Not sure why these fields are sometimes serialized but
             # mostly not... regardless they cause problems because they
             # are just properties of the model and not fields.
             result_dict.pop('state_name', None)
             result_dict.pop('state_type_name', None)
             try:
-                result_obj = Result(result_dict, origin=result)
+                result_obj = Result(result_dict, origin=message)
                 result_obj.validate()
+                results.append(result_obj)
             except Exception as e:
                 logger.debug('Got unexpected message: %s', result_dict)
                 logger.exception(
                     'Error reading result from queue: %s', e.message)
-        return result_obj
+        return results
+
+    def _receive_messages(self, **kwargs):
+        wait_time = kwargs.get('wait_time', 0)
+        visibility_timeout = kwargs.get('visibility_timeout', None)
+        # Don't leave handled messages waiting on a long poll.
+        self.flush_deletes()
+        logger.debug("Getting up to %d results from queue %s.",
+                     self.receive_batch_size, self.queue_name)
+        messages = self.queue.get_messages(
+            num_messages=self.receive_batch_size,
+            visibility_timeout=visibility_timeout,
+            wait_time_seconds=wait_time)
+        if visibility_timeout:
+            expires = time.time() + visibility_timeout
+            for message in messages:
+                self._leases[message.id] = (message, expires)
+        return messages
+
+    def renew_leases(self, visibility_timeout):
+        """ Makes sure every message the reactor holds stays invisible for
+        long enough to handle another result, extending the visibility
+        timeout of those with less than half of it left.  Messages that are
+        only waiting to be deleted are deleted instead.
+        """
+        now = time.time()
+        due = set(message_id for message_id, (m, expires)
+                  in self._leases.iteritems()
+                  if expires - now < visibility_timeout / 2.0)
+        if not due:
+            return
+        if any(m.id in due for m in self._pending_deletes):
+            self.flush_deletes()
+        due = [self._leases[message_id][0] for message_id in due
+               if message_id in self._leases]
+        for i in range(0, len(due), MAX_BATCH_SIZE):
+            self._renew_leases(due[i:i + MAX_BATCH_SIZE], visibility_timeout)
+
+    def _renew_leases(self, batch, visibility_timeout):
+        logger.debug("Extending visibility of %d results by %d seconds.",
+                     len(batch), visibility_timeout)
+        expires = time.time() + visibility_timeout
+        try:
+            response = self.queue.change_message_visibility_batch(
+                [(message, visibility_timeout) for message in batch])
+        except SQSError:
+            logger.exception("Unable to extend visibility of %d result "
+                             "messages:", len(batch))
+            return
+        failed = set(error['id'] for error in response.errors)
+        for message in batch:
+            if message.id not in failed:
+                self._leases[message.id] = (message, expires)
+                continue
+            # Most likely the message's receipt has already expired, so it
+            # will be (or has been) handed out again.
+            logger.error("Unable to extend visibility of result message %s.",
+                         message.id)
+            if message in self._message_buffer:
+                logger.error("Skipping result message %s.", message.id)
+                self._message_buffer.remove(message)
+                del self._leases[message.id]
+
+    def get_result(self, **kwargs):
+        visibility_timeout = kwargs.get('visibility_timeout', None)
+        if visibility_timeout:
+            self.renew_leases(visibility_timeout)
+        if self._result_buffer:
+            return self._result_buffer.popleft()
+
+        if not self._message_buffer:
+            self._message_buffer.extend(self._receive_messages(**kwargs))
+        if not self._message_buffer:
+            return None
+        message = self._message_buffer.popleft()
+        results = self.decode_results(message)
+        if not results:
+            # Left for the queue to deal with
+            self._leases.pop(message.id, None)
+            return None
+        self._unhandled_results[message.id] = len(results)
+        self._result_buffer.extend(results)
+        return self._result_buffer.popleft()
 
     def delete_result(self, result):
-        self.queue.delete_message(result._origin)
+        message = result._origin
+        self._unhandled_results[message.id] -= 1
+        if self._unhandled_results[message.id]:
+            return
+        del self._unhandled_results[message.id]
+        self._pending_deletes.append(message)
+        if len(self._pending_deletes) >= self.delete_batch_size:
+            self.flush_deletes()
+
+    def flush_deletes(self):
+        pending = self._pending_deletes
+        self._pending_deletes = []
+        for message in pending:
+            self._leases.pop(message.id, None)
+        for i in range(0, len(pending), MAX_BATCH_SIZE):
+            self._delete_messages(pending[i:i + MAX_BATCH_SIZE])
+
+    def _delete_messages(self, batch):
+        if len(batch) == 1:
+            self.queue.delete_message(batch[0])
+            return
+        logger.debug("Deleting %d results from queue %s.", len(batch),
+                     self.queue_name)
+        response = self.queue.delete_message_batch(batch)
+        for error in response.errors:
+            logger.error("Unable to delete result message %s: %s",
+                         error['id'], error.get('error_message'))
+
+    def run(self, handler_config_path, **kwargs):
+        try:
+            return super(AWSReactor, self).run(handler_config_path, **kwargs)
+        finally:
+            self.flush_deletes()
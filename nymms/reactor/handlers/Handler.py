@@ -12,6 +12,8 @@ class Handler(object):
         self._suppression_enabled = self.config.pop(
             'suppression_enabled',
             False)
+        # How long the reactor waits for this handler, see Reactor
+        self.timeout = self.config.pop('timeout', None)
         logger.debug("%s suppression enabled is %s",
                      self.__class__.__name__,
                      self._suppression_enabled)
@@ -1,6 +1,11 @@
 import unittest
+import json
+import threading
+import time
 
 from nymms.reactor.Reactor import Reactor
+from nymms.reactor.aws_reactor import AWSReactor
+from nymms.schemas import Result, types, codec
 from nymms.reactor.handlers.Handler import Handler
 
 
@@ -22,3 +27,268 @@ class TestReactor(unittest.TestCase):
     def test_load_disabled_handler(self):
         handler = self.reactor.load_handler('dummy_handler', disabled_config)
         self.assertIs(handler, None)
+
+
+class SlowHandler(object):
+    def __init__(self, delay, log, timeout=None):
+        self.delay = delay
+        self.log = log
+        self.timeout = timeout
+        self.results = []
+
+    def process(self, result, previous_state, is_suppressed):
+        time.sleep(self.delay)
+        self.log.append((self.delay, threading.current_thread().name))
+        self.results.append(result.id)
+
+
+class DummyStateReactor(Reactor):
+    def __init__(self, handlers):
+        super(DummyStateReactor, self).__init__()
+        self.handlers = handlers
+        self.saved = []
+
+    def get_state(self, task_id):
+        return None
+
+    def save_state(self, task_id, result, previous):
+        self.saved.append((task_id, list(self.handled)))
+
+
+class TestHandlerDispatch(unittest.TestCase):
+    def setUp(self):
+        self.handled = []
+        self.reactor = DummyStateReactor({
+            'slow': SlowHandler(0.3, self.handled),
+            'slower': SlowHandler(0.3, self.handled),
+            'fast': SlowHandler(0, self.handled)})
+        self.reactor.handled = self.handled
+        self.result = Result({'id': 'test:1', 'state': types.STATE_OK,
+                              'state_type': types.STATE_TYPE_HARD})
+
+    def test_sequential(self):
+        self.reactor.handle_result(self.result)
+        self.assertEqual(len(self.reactor.saved[0][1]), 3)
+        self.assertEqual(set(name for d, name in self.handled),
+                         set([threading.current_thread().name]))
+
+    def test_concurrent(self):
+        start = time.time()
+        self.reactor.handle_result(self.result, handler_workers=3,
+                                   handler_timeout=5)
+        self.assertLess(time.time() - start, 0.55)
+        # State is only saved once every handler is done
+        self.assertEqual(len(self.reactor.saved[0][1]), 3)
+
+    def test_timeout(self):
+        self.reactor.handlers['slower'].delay = 1
+        self.reactor.handlers['slower'].timeout = 0.1
+        self.reactor.handle_result(self.result, handler_workers=3,
+                                   handler_timeout=5)
+        # Waited for 'slow' but not for 'slower'
+        self.assertEqual(sorted(d for d, n in self.reactor.saved[0][1]),
+                         [0, 0.3])
+
+    def test_busy_handler_queued(self):
+        slower = self.reactor.handlers['slower']
+        slower.delay = 0.5
+        slower.timeout = 0.1
+        results = [Result({'id': 'test:%d' % i, 'state': types.STATE_OK,
+                           'state_type': types.STATE_TYPE_HARD})
+                   for i in range(3)]
+        for result in results:
+            self.reactor.handle_result(result, handler_workers=3,
+                                       handler_timeout=5)
+        # 'slower' was still busy with the first result during the others,
+        # which waited for it rather than being dropped
+        self.assertEqual(len(self.reactor.saved), 3)
+        time.sleep(1.2)
+        self.assertEqual(slower.results, ['test:0', 'test:1', 'test:2'])
+        self.assertEqual(self.reactor._handler_pending, {})
+
+
+class DummyManager(object):
+    def __init__(self, *args):
+        pass
+
+
+class DummyMessage(object):
+    def __init__(self, message_id, message):
+        self.id = message_id
+        self.body = json.dumps({'Message': message})
+        self.visibility_changes = []
+        self.expired = False
+
+    def get_body(self):
+        return self.body
+
+
+class DummyBatchResults(object):
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+
+
+class StopReactor(Exception):
+    pass
+
+
+class DummyQueue(object):
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.deleted = []
+        self.receives = []
+        self.delete_batches = []
+
+    def get_messages(self, num_messages=1, visibility_timeout=None,
+                     wait_time_seconds=None):
+        self.receives.append((num_messages, visibility_timeout))
+        messages = self.messages[:num_messages]
+        del self.messages[:num_messages]
+        return messages
+
+    def delete_message(self, message):
+        self.deleted.append(message)
+
+    def delete_message_batch(self, messages):
+        self.delete_batches.append(list(messages))
+        self.deleted.extend(messages)
+        return DummyBatchResults()
+
+    def change_message_visibility_batch(self, messages):
+        errors = []
+        for message, visibility_timeout in messages:
+            if message.expired:
+                errors.append({'id': message.id})
+            else:
+                message.visibility_changes.append(visibility_timeout)
+        return DummyBatchResults(errors)
+
+
+def make_result(task_id):
+    return Result({'id': task_id, 'state': types.STATE_OK,
+                   'state_type': types.STATE_TYPE_HARD}).to_primitive()
+
+
+class TestAWSReactor(unittest.TestCase):
+    def setUp(self):
+        self.reactor = AWSReactor('us-east-1', 'results', 'state', 'queue',
+                                  'suppress', state_manager=DummyManager,
+                                  suppression_manager=DummyManager)
+
+    def test_single_result(self):
+        message = DummyMessage('1', json.dumps(make_result('test:1')))
+        self.reactor._queue = DummyQueue([message])
+        result = self.reactor.get_result()
+        self.assertEqual(result.id, 'test:1')
+        self.reactor.delete_result(result)
+        self.assertEqual(self.reactor._queue.deleted, [message])
+
+    def test_batched_results(self):
+        batch = {'results': [make_result('test:1'), make_result('test:2')]}
+        message = DummyMessage('1', json.dumps(batch))
+        self.reactor._queue = DummyQueue([message])
+        first = self.reactor.get_result()
+        self.reactor.delete_result(first)
+        # the message isn't deleted until every result in it is handled
+        self.assertEqual(self.reactor._queue.deleted, [])
+        second = self.reactor.get_result()
+        self.reactor.delete_result(second)
+        self.assertEqual([first.id, second.id], ['test:1', 'test:2'])
+        self.assertEqual(self.reactor._queue.deleted, [message])
+        self.assertIs(self.reactor.get_result(), None)
+
+    def test_encoded_batched_results(self):
+        header = codec.get_codec('json').header()
+        batch = {'results': [header + json.dumps(make_result('test:1')),
+                             make_result('test:2')]}
+        message = DummyMessage('1', json.dumps(batch))
+        self.reactor._queue = DummyQueue([message])
+        results = [self.reactor.get_result(), self.reactor.get_result()]
+        self.assertEqual([r.id for r in results], ['test:1', 'test:2'])
+
+    def test_multiple_results_extend_visibility(self):
+        batch = {'results': [make_result('test:1'), make_result('test:2')]}
+        message = DummyMessage('1', json.dumps(batch))
+        self.reactor._queue = DummyQueue([message])
+        self.reactor.get_result(visibility_timeout=30)
+        self.reactor.get_result(visibility_timeout=30)
+        self.assertEqual(message.visibility_changes, [])
+        # Pretend the first result took most of the timeout
+        self.reactor._leases['1'] = (message, time.time() + 5)
+        self.reactor.get_result(visibility_timeout=30)
+        self.assertEqual(message.visibility_changes, [30])
+
+
+class TestAWSReactorBatching(unittest.TestCase):
+    def setUp(self):
+        self.reactor = AWSReactor('us-east-1', 'results', 'state', 'queue',
+                                  'suppress', state_manager=DummyManager,
+                                  suppression_manager=DummyManager,
+                                  receive_batch_size=3, delete_batch_size=2)
+        self.messages = [DummyMessage(str(i), json.dumps(
+            make_result('test:%d' % i))) for i in range(5)]
+        self.queue = self.reactor._queue = DummyQueue(self.messages)
+
+    def expire_leases(self, seconds_left=5):
+        for message_id, (message, expires) in self.reactor._leases.items():
+            self.reactor._leases[message_id] = (message,
+                                                time.time() + seconds_left)
+
+    def test_batched_receive_and_delete(self):
+        for i in range(3):
+            result = self.reactor.get_result(visibility_timeout=30)
+            self.assertEqual(result.id, 'test:%d' % i)
+            self.reactor.delete_result(result)
+        # One receive for the first three, each with its own timeout
+        self.assertEqual(self.queue.receives, [(3, 30)])
+        self.assertEqual(self.queue.delete_batches, [self.messages[:2]])
+        # The last handled message is deleted before receiving again
+        result = self.reactor.get_result(visibility_timeout=30)
+        self.assertEqual(result.id, 'test:3')
+        self.assertEqual(self.queue.deleted, self.messages[:3])
+        self.assertEqual(len(self.queue.receives), 2)
+        self.assertEqual([m.visibility_changes for m in self.messages],
+                         [[]] * 5)
+
+    def test_waiting_messages_extended(self):
+        first = self.reactor.get_result(visibility_timeout=30)
+        # Pretend the first result took most of the timeout
+        self.expire_leases()
+        self.reactor.delete_result(first)
+        self.reactor.get_result(visibility_timeout=30)
+        # The waiting messages are extended, the handled one is deleted
+        # rather than left to become visible again.
+        self.assertEqual(self.queue.deleted, self.messages[:1])
+        self.assertEqual([m.visibility_changes for m in self.messages[:3]],
+                         [[], [30], [30]])
+        self.assertEqual(sorted(self.reactor._leases), ['1', '2'])
+
+    def test_expired_message_skipped(self):
+        first = self.reactor.get_result(visibility_timeout=30)
+        self.expire_leases()
+        self.messages[1].expired = True
+        self.reactor.delete_result(first)
+        # The next message is handled as usual, the skipped one never is
+        result = self.reactor.get_result(visibility_timeout=30)
+        self.assertEqual(result.id, 'test:2')
+        self.reactor.delete_result(result)
+        self.reactor.flush_deletes()
+        self.assertEqual(self.queue.deleted,
+                         [self.messages[0], self.messages[2]])
+        self.assertEqual(self.reactor._leases, {})
+
+    def test_deletes_flushed_on_exit(self):
+        handled = []
+
+        def handle_result(result, **kwargs):
+            handled.append(result)
+            if len(handled) == 2:
+                raise StopReactor()
+
+        self.reactor.load_handlers = lambda *args, **kwargs: None
+        self.reactor.handle_result = handle_result
+        with self.assertRaises(StopReactor):
+            self.reactor.run('handlers', visibility_timeout=30)
+        # The first result was handled, but not yet deleted as part of a
+        # full batch.
+        self.assertEqual(self.queue.deleted, self.messages[:1])
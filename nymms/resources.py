@@ -2,16 +2,14 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-import copy
+import collections
 from weakref import WeakValueDictionary
 
 from nymms import registry
-from nymms.utils import commands
+from nymms.utils import commands, templates, load_object_from_string
 from nymms.config import yaml_config
 from nymms.exceptions import MissingCommandContext
 
-from jinja2 import Template
-from jinja2.runtime import StrictUndefined
 from jinja2.exceptions import UndefinedError
 
 
@@ -19,6 +17,84 @@ RESERVED_ATTRIBUTES = ['name', 'address', 'node_monitor', 'monitoring_groups',
                        'command_string']
 
 
+class LayeredContext(collections.Mapping):
+    """ A read-only, merged view over a stack of context dictionaries.
+
+    Layers are given lowest priority first, so a key in a later layer hides
+    the same key in any earlier layer.  Building a new context on top of an
+    existing one only adds a reference to the new layer, rather than copying
+    everything beneath it.
+
+    The layers themselves are shared between every context built on top of
+    them, so they should never be modified.
+    """
+    def __init__(self, *layers):
+        self.layers = layers
+
+    def __getitem__(self, key):
+        for layer in reversed(self.layers):
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return any(key in layer for layer in self.layers)
+
+    def __iter__(self):
+        seen = set()
+        for layer in reversed(self.layers):
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return len(set().union(*self.layers))
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.to_dict())
+
+    def _push(self, layer, bottom=False):
+        if bottom:
+            return LayeredContext(layer, *self.layers)
+        return LayeredContext(*(self.layers + (layer,)))
+
+    @classmethod
+    def from_context(cls, context):
+        if isinstance(context, cls):
+            return context
+        return cls(context)
+
+    def new_child(self, layer):
+        """ Returns a new context with layer on top of this one. """
+        return self._push(layer)
+
+    def new_defaults(self, layer):
+        """ Returns a new context with layer underneath this one, so that it
+        only provides values for keys that aren't already set.
+        """
+        return self._push(layer, bottom=True)
+
+    def to_dict(self):
+        """ Returns the merged context as a (shallow) dictionary. """
+        merged = {}
+        for layer in self.layers:
+            merged.update(layer)
+        return merged
+
+
+def context_layer(context):
+    """ Given a resource's context ({<resource type>: {<attributes>}})
+    returns the layer it adds to a merged context: the context itself, plus
+    all of the attributes (other than name) at the top level.
+    """
+    layer = dict(context)
+    for k, v in context.values()[0].iteritems():
+        if not k == 'name':
+            layer[k] = v
+    return layer
+
+
 class RegistryMetaClass(type):
     """ Creates a registry of all objects of a classes type.
 
@@ -54,6 +130,7 @@ class NanoResource(object):
                                 disallowed_attributes)))
         self.extra_attributes = kwargs
         self._context_cache = None
+        self._context_layer_cache = None
 
         self.register()
 
@@ -77,14 +154,19 @@ class NanoResource(object):
         self._context_cache = {context_key: context}
         return self._context_cache
 
+    def _context_layer(self):
+        """ Returns the layer this resource adds to a context: its context
+        under its own key, plus all of its attributes (other than name) at
+        the top level.
+        """
+        if self._context_layer_cache:
+            return self._context_layer_cache
+        self._context_layer_cache = context_layer(self._context())
+        return self._context_layer_cache
+
     def build_context(self, context):
-        context = copy.deepcopy(context)
-        c = self._context()
-        context.update(c)
-        for k, v in c.values()[0].iteritems():
-            if not k == 'name':
-                context[k] = v
-        return context
+        return LayeredContext.from_context(context).new_child(
+            self._context_layer())
 
 
 class MonitoringGroup(NanoResource):
@@ -151,6 +233,16 @@ class Node(NanoResource):
 
         super(Node, self).__init__(name, **kwargs)
 
+    def unregister(self):
+        """ Removes the node from the Node registry and from its monitoring
+        groups, so that a new version of it can be loaded.
+        """
+        logger.debug("Unregistering node '%s'.", self.name)
+        for group in self.monitoring_groups.values():
+            group.nodes.pop(self.name, None)
+        if self.registry.get(self.name) is self:
+            del self.registry[self.name]
+
     def _build_context(self, monitoring_group, monitor):
         context = {}
         for obj in (monitoring_group, self, monitor):
@@ -197,42 +289,100 @@ class Monitor(NanoResource):
 
         super(Monitor, self).__init__(name, **kwargs)
 
-    def execute(self, context, timeout, private_context=None):
-        return self.command.execute(context, timeout, private_context)
+    def execute(self, context, timeout, private_context=None, stats=None):
+        return self.command.execute(context, timeout, private_context, stats)
 
     def format_command(self, context, private_context=None):
         return self.command.format_command(context, private_context)
 
 
 class Command(NanoResource):
+    """ A command run by the probe.
+
+    For the default 'nagios' command_type the command_string is a template
+    of a command line to run.  For the 'python' command_type it is instead
+    the '.' delimited path to a callable (see nymms.probe.checks) which is
+    run inside the probe itself.
+    """
     context_attributes = ['name', 'command_type', 'command_string']
 
     def __init__(self, name, command_string, command_type='nagios', **kwargs):
         self.command_type = command_type
         self.command_string = command_string
+        self._callable = None
         super(Command, self).__init__(name, **kwargs)
 
-    def format_command(self, context, private_context=None):
+    @property
+    def template(self):
+        # Looked up every time, so that the shared Environment's LRU (see
+        # nymms.utils.templates) decides what stays compiled.
+        return templates.get_template(self.command_string)
+
+    @property
+    def callable(self):
+        if not self._callable:
+            self._callable = load_object_from_string(self.command_string)
+        return self._callable
+
+    def command_context(self, context, private_context=None):
         my_context = self._context()
-        local_context = copy.deepcopy(context)
-        local_context.update(my_context)
-        local_context['__private'] = {}
-        if private_context:
-            local_context['__private'].update(private_context)
-        for k, v in my_context.values()[0].iteritems():
-            if not k == 'name' and k not in local_context:
-                local_context[k] = v
-        t = Template(self.command_string)
-        t.environment.undefined = StrictUndefined
+        # The command's attributes are only defaults, anything set in the
+        # given context wins.
+        defaults = dict((k, v) for k, v in my_context.values()[0].iteritems()
+                        if not k == 'name')
+        return LayeredContext.from_context(context).new_defaults(
+            defaults).new_child(my_context).new_child(
+                {'__private': private_context or {}})
+
+    def format_command(self, context, private_context=None):
+        local_context = self.command_context(context, private_context)
         try:
-            out = t.render(local_context)
+            out = self.template.render(local_context)
         except UndefinedError as e:
             raise MissingCommandContext(e.message)
         return out
 
-    def execute(self, context, timeout, private_context=None):
+    def execute(self, context, timeout, private_context=None, stats=None):
+        if self.command_type == 'python':
+            local_context = self.command_context(context, private_context)
+            return commands.execute_callable(self.command_string,
+                                             self.callable, local_context,
+                                             timeout, stats)
         cmd = self.format_command(context, private_context)
-        return commands.execute(cmd, timeout)
+        return commands.execute(cmd, timeout, stats)
+
+
+def compact_task_context(context):
+    """ Splits a task context built by Node.monitors into a reference to the
+    monitoring group & monitor it was built from, and the small context
+    that can't be rebuilt from the resources: the node's attributes and the
+    task's realm (used by the scheduler to pick a queue).
+
+    See build_task_context for the reverse.
+    """
+    reference = {'monitoringgroup': context['monitoringgroup']['name'],
+                 'monitor': context['monitor']['name']}
+    overrides = {'node': context['node'], 'realm': context.get('realm')}
+    return reference, overrides
+
+
+def build_task_context(reference, overrides):
+    """ Rebuilds a full task context from the monitoring group & monitor in
+    reference, using the local registries, and the node in overrides.
+    Anything else in overrides is layered on top.
+
+    Raises KeyError if the monitoring group or monitor isn't in the local
+    registries.
+    """
+    group = MonitoringGroup.registry[reference['monitoringgroup']]
+    monitor = Monitor.registry[reference['monitor']]
+    overrides = dict(overrides)
+    node_layer = context_layer({'node': overrides.pop('node', {})})
+    context = monitor.build_context(
+        LayeredContext(group._context_layer(), node_layer))
+    if overrides:
+        context = context.new_child(overrides)
+    return context
 
 
 def load_resource(resources, resource_class, reset=False):
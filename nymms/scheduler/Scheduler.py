@@ -1,56 +1,287 @@
+import hashlib
+import heapq
 import logging
 import time
 
 from nymms.daemon import NymmsDaemon
-from nymms.resources import Node
+from nymms.resources import Node, compact_task_context
 from nymms.scheduler.lock.SchedulerLock import NoOpLock
 from nymms.schemas import Task
 
 logger = logging.getLogger(__name__)
 
+DISPATCH_BURST = 'burst'
+DISPATCH_SPREAD = 'spread'
+DISPATCH_DUE = 'due'
+
+# How long to wait before trying the lock again when another scheduler has it
+LOCK_RETRY_INTERVAL = 10
+
+
+def splay(task_id, interval):
+    """ Returns a stable offset, in seconds, between 0 and interval for the
+    given task id.  The same task always gets the same offset, and offsets
+    are spread evenly over the interval.
+    """
+    if isinstance(task_id, unicode):
+        task_id = task_id.encode('utf-8')
+    digest = int(hashlib.md5(task_id).hexdigest()[:8], 16)
+    return interval * digest / float(0x100000000)
+
+
+def _aligned_due(task_id, interval, now):
+    """ Returns the first time, after now, that a task is due at its stable
+    offset within its interval.
+    """
+    due = now - (now % interval) + splay(task_id, interval)
+    if due < now:
+        due += interval
+    return due
+
+
+class DueTasks(object):
+    """ A min-heap of tasks keyed on when they are next due.
+
+    Each task has its own interval.  Tasks are first due at their stable
+    offset (see splay) into their interval, so the first run of a task after
+    a restart or a lock takeover happens when it would have anyway.
+    Entries for tasks that have been removed or changed are left in the
+    heap and skipped when they come up.
+    """
+    def __init__(self):
+        self._heap = []
+        # task_id -> [due, task_id, task_context, interval]
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _push(self, entry):
+        self._entries[entry[1]] = entry
+        heapq.heappush(self._heap, entry)
+
+    def update(self, tasks, now=None):
+        """ Updates the tasks from a dictionary of task_id ->
+        (task_context, interval).  New tasks are added, tasks that are no
+        longer there are dropped and existing tasks keep their next due
+        time (unless their interval shrank below it).
+        """
+        now = now or time.time()
+        for task_id in set(self._entries) - set(tasks):
+            logger.debug("Task %s is gone, removing it.", task_id)
+            self._entries.pop(task_id)[1] = None
+        for task_id, (task_context, interval) in tasks.iteritems():
+            entry = self._entries.get(task_id)
+            if not entry:
+                due = _aligned_due(task_id, interval, now)
+                self._push([due, task_id, task_context, interval])
+                continue
+            entry[2] = task_context
+            if not entry[3] == interval:
+                due = min(entry[0], _aligned_due(task_id, interval, now))
+                entry[1] = None
+                self._push([due, task_id, task_context, interval])
+
+    def next_due(self):
+        while self._heap and self._heap[0][1] is None:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def pop_due(self, now=None):
+        """ Returns the context of every task that is due, and schedules each
+        of them to be due again one interval later.  If a task has missed
+        more than one run (the scheduler fell behind) it only runs once, and
+        stays on its original offset.
+        """
+        now = now or time.time()
+        due_tasks = []
+        while self.next_due() is not None and self._heap[0][0] <= now:
+            due, task_id, task_context, interval = heapq.heappop(self._heap)
+            missed = int((now - due) // interval)
+            if missed:
+                logger.debug("Task %s missed %d runs, catching up.", task_id,
+                             missed)
+            self._push([due + (missed + 1) * interval, task_id, task_context,
+                        interval])
+            due_tasks.append(task_context)
+        return due_tasks
+
 
 class Scheduler(NymmsDaemon):
+    """ Submits a task for every monitor on every node.
+
+    Normally only the scheduler holding the lock schedules anything.  If a
+    membership (see nymms.scheduler.membership) is given instead, every
+    scheduler in the group runs at once, and each only schedules the nodes
+    it owns in the group's hash ring.
+
+    If resources_version (the version returned by load_resources) is given
+    then tasks are sent in a compact form: rather than the whole context,
+    only the node, the task's realm and a reference to the monitoring group
+    & monitor are sent, and the probe rebuilds the rest from its own copy
+    of the resources.
+    """
     task_id_template = "{node[name]}:{monitor[name]}"
 
-    def __init__(self, node_backend, lock=None):
+    def __init__(self, node_backend, lock=None, membership=None,
+                 resources_version=None):
         self._node_backend = node_backend
-        if not lock:
+        self._membership = membership
+        self.resources_version = resources_version
+        if not lock and not membership:
             lock = NoOpLock()
 
         self._lock = lock
         super(Scheduler, self).__init__()
 
+    def acquire(self):
+        """ Returns True if this scheduler should schedule tasks.  When
+        sharded this is always the case, and the heartbeat also refreshes
+        which nodes this scheduler owns.
+        """
+        if self._membership:
+            self._membership.heartbeat()
+            return True
+        return self._lock.acquire()
+
+    def owns_node(self, node_name):
+        if not self._membership:
+            return True
+        return self._membership.owns(node_name)
+
     def get_tasks(self):
         tasks = {}
         self._node_backend.load_nodes()
         nodes = Node.registry
         for node_name, node in nodes.iteritems():
-            tasks[node_name] = node.monitors
+            if not self.owns_node(node_name):
+                continue
+            # Copy the list, so that the node's cached tasks aren't used up
+            # by run_once.
+            tasks[node_name] = list(node.monitors)
         return tasks
 
+    def get_due_tasks(self, default_interval):
+        """ Returns a dictionary of task_id -> (task_context, interval) for
+        every task.  A task's interval comes from the 'interval' in its
+        context (set on the monitor, node or monitoring group), falling back
+        to default_interval.
+        """
+        due_tasks = {}
+        for node_tasks in self.get_tasks().itervalues():
+            for task_context in node_tasks:
+                task_id = self.task_id(task_context)
+                interval = task_context.get('interval', default_interval)
+                try:
+                    interval = int(interval)
+                    if interval < 1:
+                        raise ValueError(interval)
+                except (TypeError, ValueError):
+                    logger.error("Invalid interval '%s' for task %s, using "
+                                 "%d.", interval, task_id, default_interval)
+                    interval = default_interval
+                due_tasks[task_id] = (task_context, interval)
+        return due_tasks
+
     def submit_task(self, task, **kwargs):
         raise NotImplementedError
 
+    def main(self, *args, **kwargs):
+        try:
+            super(Scheduler, self).main(*args, **kwargs)
+        finally:
+            if self._membership:
+                # Let the other schedulers pick up our nodes straight away
+                self._membership.leave()
+
+    def check_backlog(self, realms, **kwargs):
+        """ Called at the start of every sweep, with the set of realms the
+        sweep has tasks for (None being the default realm), so that
+        subclasses can look at how far behind the probes are before
+        submitting more tasks.
+        """
+        pass
+
+    def flush_tasks(self, **kwargs):
+        """ Called whenever the scheduler is about to wait, so that
+        subclasses that buffer submitted tasks can send them on.
+        """
+        pass
+
     def run(self, **kwargs):
         interval = kwargs.get('interval')
+        dispatch = kwargs.get('dispatch') or DISPATCH_BURST
+        if dispatch == DISPATCH_DUE:
+            return self.run_due(**kwargs)
+        next_window = None
         while True:
             start = time.time()
-            if self._lock.acquire():
-                self.run_once(**kwargs)
+            if self.acquire():
+                if dispatch == DISPATCH_SPREAD:
+                    window_start = next_window
+                    if not window_start or window_start + interval <= start:
+                        # First run, or we've fallen a whole window behind
+                        window_start = start - (start % interval)
+                    self.run_once(window_start=window_start, **kwargs)
+                    # The last tasks of a window are submitted right before
+                    # it ends, so work from the window rather than the
+                    # clock, otherwise finishing a moment late would skip
+                    # the next window entirely.
+                    next_window = window_start + interval
+                    sleep_time = next_window - time.time()
+                else:
+                    self.run_once(**kwargs)
+                    sleep_time = interval - max(time.time() - start, 0)
                 run_time = time.time() - start
                 logger.info("Scheduler iteration took %d seconds.", run_time)
-                sleep_time = interval - max(run_time, 0)
+                if sleep_time < 0:
+                    logger.warning("Scheduler iteration overran the %d second "
+                                   "interval, starting the next one now.",
+                                   interval)
+                    sleep_time = 0
                 logger.info("Scheduler sleeping for %d seconds.", sleep_time)
             else:
+                next_window = None
                 # Only sleep for 10 seconds before checking the lock again
                 # when we don't acquire the lock. Allows for faster takeover.
-                sleep_time = 10
+                sleep_time = LOCK_RETRY_INTERVAL
                 logger.info("Failed to acquire lock, sleeping for %d seconds.",
                             sleep_time)
             time.sleep(sleep_time)
 
+    def task_id(self, task_context):
+        return self.task_id_template.format(**task_context)
+
+    def make_task(self, task_context):
+        task_id = self.task_id(task_context)
+        if not self.resources_version:
+            return Task({
+                'id': task_id,
+                'context': task_context})
+        reference, overrides = compact_task_context(task_context)
+        reference['version'] = self.resources_version
+        return Task({
+            'id': task_id,
+            'context': overrides,
+            'reference': reference})
+
     def run_once(self, **kwargs):
+        """ Submits a task for every monitor on every node.
+
+        With the default 'burst' dispatch every task is submitted right
+        away.  With 'spread' dispatch each task is instead submitted at its
+        own offset (see splay) into the current interval, which is aligned
+        to the clock, so that the load on the probes stays flat rather than
+        spiking at the start of each interval.
+        """
         tasks = self.get_tasks()
+        self.check_backlog(set(task_context.get('realm')
+                               for node_tasks in tasks.itervalues()
+                               for task_context in node_tasks), **kwargs)
+        if kwargs.get('dispatch') == DISPATCH_SPREAD:
+            return self.dispatch_spread(tasks, **kwargs)
         # This is done to make sure we submit one task per node until we've
         # submitted all the tasks.  This helps ensure we don't hammer a
         # single node with monitoring tasks
@@ -60,12 +291,77 @@ class Scheduler(NymmsDaemon):
                 break
             for node in working_index:
                 try:
-                    task_context = tasks[node].pop()
-                    task_id = self.task_id_template.format(**task_context)
-                    task = Task({
-                        'id': task_id,
-                        'context': task_context})
+                    task = self.make_task(tasks[node].pop())
                 except IndexError:
                     del(tasks[node])
                     continue
                 self.submit_task(task, **kwargs)
+        self.flush_tasks(**kwargs)
+
+    def dispatch_spread(self, tasks, window_start=None, **kwargs):
+        interval = kwargs.get('interval')
+        if window_start is None:
+            window_start = time.time() - (time.time() % interval)
+        schedule = []
+        for node_tasks in tasks.itervalues():
+            for task_context in node_tasks:
+                task_id = self.task_id(task_context)
+                schedule.append((splay(task_id, interval), task_context))
+        schedule.sort(key=lambda item: item[0])
+        logger.debug("Spreading %d tasks over %d seconds.", len(schedule),
+                     interval)
+        # Tasks whose offset has already passed (say on the first iteration
+        # after startup) are submitted straight away.
+        for offset, task_context in schedule:
+            delay = window_start + offset - time.time()
+            if delay > 0:
+                self.flush_tasks(**kwargs)
+                time.sleep(delay)
+            # Only make the task now, so that it's created when it's sent
+            self.submit_task(self.make_task(task_context), **kwargs)
+        self.flush_tasks(**kwargs)
+
+    def run_due(self, **kwargs):
+        """ Submits each task whenever it is due, according to its own
+        interval (see DueTasks), rather than sweeping every task each
+        interval.  The nodes & resources are reloaded, and the lock (or
+        membership heartbeat) renewed, every scheduler interval.
+        """
+        interval = kwargs.get('interval')
+        due_tasks = DueTasks()
+        have_lock = False
+        next_lock = next_refresh = 0
+        while True:
+            now = time.time()
+            if now >= next_lock:
+                ring = self._membership and self._membership.ring
+                have_lock = self.acquire()
+                if self._membership and self._membership.ring is not ring:
+                    # Nodes have moved between schedulers
+                    next_refresh = 0
+                if not have_lock:
+                    logger.info("Failed to acquire lock, sleeping for %d "
+                                "seconds.", LOCK_RETRY_INTERVAL)
+                    # Whoever has the lock is running the tasks now.
+                    due_tasks = DueTasks()
+                    next_refresh = 0
+                    next_lock = now + LOCK_RETRY_INTERVAL
+                    time.sleep(LOCK_RETRY_INTERVAL)
+                    continue
+                next_lock = now + interval
+            if now >= next_refresh:
+                sweep = self.get_due_tasks(interval)
+                due_tasks.update(sweep, now)
+                self.check_backlog(set(task_context.get('realm') for
+                                       task_context, _ in sweep.itervalues()),
+                                   **kwargs)
+                logger.info("Scheduling %d tasks.", len(due_tasks))
+                next_refresh = now + interval
+            for task_context in due_tasks.pop_due(now):
+                self.submit_task(self.make_task(task_context), **kwargs)
+            self.flush_tasks(**kwargs)
+            wake = min(next_lock, next_refresh)
+            next_due = due_tasks.next_due()
+            if next_due is not None:
+                wake = min(wake, next_due)
+            time.sleep(max(wake - time.time(), 0))
@@ -1,20 +1,74 @@
 import logging
-import json
+import random
+import threading
+import Queue
 
+from boto.exception import BotoServerError
 from boto.sqs.message import Message
 
 from nymms.scheduler.Scheduler import Scheduler
+from nymms.schemas import codec
 
 logger = logging.getLogger(__name__)
 
+# The most messages SQS will accept in a single send_message_batch request.
+MAX_BATCH_SIZE = 10
+# How many times entries that fail in a batch are retried before giving up
+MAX_SUBMIT_ATTEMPTS = 3
+
+# What to do with tasks for a queue that is over the backlog limit
+BACKLOG_SKIP = 'skip'
+BACKLOG_THIN = 'thin'
+
 
 class AWSScheduler(Scheduler):
-    def __init__(self, node_backend, conn_mgr, task_queue, lock=None):
+    """ Submits tasks to SQS, to the default tasks queue or to the queue for
+    the task's realm.
+
+    If batch_size is greater than 1 then tasks are buffered per queue and
+    sent with send_message_batch whenever a batch fills up (and whenever the
+    scheduler is about to sleep).  Since the tasks are buffered in the order
+    they are submitted, the per node interleaving done by the scheduler is
+    kept.  With writers greater than 1, batches are sent by that many
+    threads in parallel.
+
+    If backlog_limit is set then before each sweep the depth of every queue
+    is checked.  For a queue with more than backlog_limit tasks waiting, the
+    sweep either skips it entirely or (with the 'thin' backlog_policy) only
+    submits a random share of its tasks (backlog_limit / tasks waiting).
+    The probes then spend their time on fresh tasks
+    rather than ones that will expire before they get to them.
+
+    Tasks are encoded with message_codec, and compressed if they're larger
+    than compress_threshold bytes (see nymms.schemas.codec).
+    """
+    def __init__(self, node_backend, conn_mgr, task_queue, lock=None,
+                 batch_size=1, writers=1, membership=None, backlog_limit=0,
+                 backlog_policy=BACKLOG_THIN, resources_version=None,
+                 message_codec=None, compress_threshold=0):
         self._conn = conn_mgr
+        self.codec = codec.get_codec(message_codec)
+        self.compress_threshold = compress_threshold
         self._queue_name = task_queue
         self._default_queue = None
         self._realm_queues = {}
-        super(AWSScheduler, self).__init__(node_backend, lock)
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.writers = writers
+        # queue name -> (queue, [tasks waiting to be sent])
+        self._pending = {}
+        self._batches = None
+        self.backlog_limit = backlog_limit
+        self.backlog_policy = backlog_policy
+        # queue name -> (tasks waiting, tasks in flight) as of the last check
+        self.backlog = {}
+        # queue name -> how far behind the queue is, in sweeps
+        self.lag = {}
+        # queue name -> share of tasks to submit this sweep, if not all
+        self._submit_ratio = {}
+        # queue name -> tasks submitted (or not) to it this sweep
+        self._sweep_counts = {}
+        super(AWSScheduler, self).__init__(node_backend, lock, membership,
+                                           resources_version)
 
     def _set_expiration(self, queue, expiration):
         if expiration:
@@ -50,10 +104,138 @@ class AWSScheduler(Scheduler):
             queue = self._default_queue
         return queue
 
+    def _queues(self):
+        queues = self._realm_queues.values()
+        if self._default_queue:
+            queues.append(self._default_queue)
+        return queues
+
+    def check_backlog(self, realms, **kwargs):
+        """ Reads the depth of every queue, and decides how many tasks to
+        submit to each during this sweep.
+        """
+        sweep_counts, self._sweep_counts = self._sweep_counts, {}
+        self._submit_ratio = {}
+        if not self.backlog_limit:
+            return
+        # Make sure every queue this sweep sends to is checked, including
+        # on the first sweep, before anything has been sent to them.
+        for realm in realms:
+            if realm:
+                self._setup_realm(realm, **kwargs)
+            else:
+                self._setup_queue(**kwargs)
+        for queue in self._queues():
+            try:
+                attributes = queue.get_attributes()
+            except BotoServerError as e:
+                logger.error("Unable to get the depth of queue %s: %s",
+                             queue.name, e)
+                continue
+            waiting = int(attributes.get('ApproximateNumberOfMessages', 0))
+            in_flight = int(attributes.get(
+                'ApproximateNumberOfMessagesNotVisible', 0))
+            self.backlog[queue.name] = (waiting, in_flight)
+            sweep_size = sweep_counts.get(queue.name)
+            if sweep_size:
+                self.lag[queue.name] = waiting / float(sweep_size)
+            if waiting <= self.backlog_limit:
+                logger.debug("Queue %s has %d tasks waiting, %d in flight.",
+                             queue.name, waiting, in_flight)
+                continue
+            if self.backlog_policy == BACKLOG_SKIP:
+                ratio = 0.0
+            else:
+                ratio = float(self.backlog_limit) / waiting
+            self._submit_ratio[queue.name] = ratio
+            logger.warning("Queue %s is backed up: %d tasks waiting (%.1f "
+                           "sweeps behind), %d in flight.  Only submitting "
+                           "%d%% of its tasks this sweep.", queue.name,
+                           waiting, self.lag.get(queue.name, 0), in_flight,
+                           ratio * 100)
+
+    def encode(self, task):
+        return codec.compress(self.codec.encode(task),
+                              self.compress_threshold)
+
     def submit_task(self, task, **kwargs):
         queue = self._choose_queue(task, **kwargs)
-        logger.debug("Sending task '%s' to queue '%s'.", task.id,
-                     queue.name)
-        m = Message()
-        m.set_body(json.dumps(task.to_primitive()))
-        return queue.write(m)
+        self._sweep_counts[queue.name] = (
+            self._sweep_counts.get(queue.name, 0) + 1)
+        ratio = self._submit_ratio.get(queue.name)
+        if ratio is not None and random.random() >= ratio:
+            logger.debug("Queue %s is backed up, not sending task '%s'.",
+                         queue.name, task.id)
+            return
+        if self.batch_size <= 1:
+            logger.debug("Sending task '%s' to queue '%s'.", task.id,
+                         queue.name)
+            m = Message()
+            m.set_body(self.encode(task))
+            return queue.write(m)
+        queue, pending = self._pending.setdefault(queue.name, (queue, []))
+        pending.append(task)
+        if len(pending) >= self.batch_size:
+            self._send_batch(queue, pending[:])
+            del pending[:]
+
+    def flush_tasks(self, **kwargs):
+        for queue, pending in self._pending.values():
+            if pending:
+                self._send_batch(queue, pending[:])
+                del pending[:]
+        if self._batches:
+            # Don't let the scheduler sleep until everything has been sent
+            self._batches.join()
+
+    def _send_batch(self, queue, tasks):
+        if self.writers <= 1:
+            return self.write_batch(queue, tasks)
+        if not self._batches:
+            self._start_writers()
+        self._batches.put((queue, tasks))
+
+    def _start_writers(self):
+        self._batches = Queue.Queue()
+        for i in range(self.writers):
+            writer = threading.Thread(target=self._writer,
+                                      name='scheduler-writer-%d' % (i,))
+            writer.daemon = True
+            writer.start()
+
+    def _writer(self):
+        while True:
+            queue, tasks = self._batches.get()
+            try:
+                self.write_batch(queue, tasks)
+            except Exception:
+                logger.exception("Unable to send %d tasks to queue %s:",
+                                 len(tasks), queue.name)
+            finally:
+                self._batches.task_done()
+
+    def write_batch(self, queue, tasks):
+        """ Sends up to 10 tasks to a queue in a single request, retrying
+        any entries that fail.
+        """
+        # Encode the bodies the same way Message does, so the probe reads
+        # them like any other task.
+        entries = [(str(i), Message(body=self.encode(task))
+                    .get_body_encoded(), 0) for i, task in enumerate(tasks)]
+        for attempt in range(1, MAX_SUBMIT_ATTEMPTS + 1):
+            logger.debug("Sending %d tasks to queue '%s'.", len(entries),
+                         queue.name)
+            response = queue.write_batch(entries)
+            failed = set()
+            for error in response.errors:
+                logger.warning("Unable to send task '%s' to queue '%s' "
+                               "(attempt %d): %s", tasks[int(error['id'])].id,
+                               queue.name, attempt,
+                               error.get('error_message'))
+                failed.add(error['id'])
+            entries = [entry for entry in entries if entry[0] in failed]
+            if not entries:
+                return
+        for entry_id, body, delay in entries:
+            logger.error("Giving up on sending task '%s' to queue '%s'.",
+                         tasks[int(entry_id)].id, queue.name)
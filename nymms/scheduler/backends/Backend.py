@@ -1,12 +1,18 @@
+import hashlib
+import json
 import logging
 
-from nymms.resources import load_resource, Node
-from nymms.registry import DuplicateEntryError
+from nymms.resources import Node
 
 logger = logging.getLogger(__name__)
 
 
 class Backend(object):
+    # The version of the nodes last loaded, and the node entries themselves,
+    # which are diffed against on the next load.
+    version = None
+    _nodes = None
+
     def _load_nodes(self):
         """ Should return a dictionary of Node information in this form:
         {'<node_name>': {<node creation kwargs>}, ...}
@@ -15,10 +21,52 @@ class Backend(object):
         """
         raise NotImplementedError
 
-    def load_nodes(self, reset=False):
+    def _load_versioned_nodes(self):
+        """ Returns a tuple of (version, nodes), where nodes is what
+        _load_nodes returns and version changes whenever the nodes do.
+
+        By default the version is a hash of the nodes, subclasses that
+        already have a version for them can override this.
+        """
         nodes = self._load_nodes()
-        try:
-            load_resource(nodes, Node, reset=reset)
-        except DuplicateEntryError:
-            # TODO: Need to figure out the story for reloading nodes, etc.
-            logger.debug("Nodes already loaded and reset is False, skipping.")
+        version = hashlib.sha512(
+            json.dumps(nodes, sort_keys=True, default=str)).hexdigest()
+        return version, nodes
+
+    def load_nodes(self, reset=False):
+        """ Loads the nodes into the Node registry.
+
+        Only the nodes that have been added, removed or changed since the
+        last load are touched, so the cached tasks (see Node.monitors) of
+        every other node are kept.  If the version of the nodes hasn't
+        changed nothing is done at all.  With reset every node is rebuilt.
+        """
+        version, nodes = self._load_versioned_nodes()
+        nodes = nodes or {}
+        if version == self.version and not reset:
+            logger.debug("Nodes are unchanged (%s), skipping reload.",
+                         version)
+            return
+        previous = self._nodes or {}
+        if reset:
+            previous = {}
+        added = changed = removed = 0
+        for name in set(previous) - set(nodes):
+            if name in Node.registry:
+                Node.registry[name].unregister()
+            removed += 1
+        for name, kwargs in nodes.iteritems():
+            kwargs = kwargs or {}
+            if name in Node.registry:
+                if name in previous and previous[name] == kwargs:
+                    continue
+                Node.registry[name].unregister()
+                changed += 1
+            else:
+                added += 1
+            Node(name, **kwargs)
+        logger.info("Loaded nodes (%s): %d added, %d changed, %d removed.",
+                    version, added, changed, removed)
+        self.version = version
+        self._nodes = dict((name, kwargs or {})
+                           for name, kwargs in nodes.iteritems())
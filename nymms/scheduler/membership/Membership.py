@@ -0,0 +1,118 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+import bisect
+import hashlib
+import threading
+import time
+import uuid
+
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """ A consistent hash ring of scheduler ids.
+
+    Each member is placed on the ring replicas times, and a key belongs to
+    the first member found clockwise from the key's own hash.  When a
+    member joins or leaves, only the keys in the ranges it gains or loses
+    move.
+    """
+    def __init__(self, members, replicas=100):
+        self.members = sorted(members)
+        self._ring = sorted((_hash('%s:%d' % (member, i)), member)
+                            for member in self.members
+                            for i in range(replicas))
+        self._points = [point for point, member in self._ring]
+
+    def get_member(self, key):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+class Membership(object):
+    """ Tracks which schedulers are alive, and which nodes each of them
+    owns.
+
+    Each scheduler heartbeats with an expiry duration seconds in the future.
+    Every scheduler whose heartbeat hasn't expired is a member, and nodes
+    are split between the members with a HashRing, so that each node is
+    scheduled by exactly one scheduler.
+    """
+    def __init__(self, duration, group_name="schedulers"):
+        self.id = self.get_instance_id()
+        self.duration = duration
+        self.group_name = group_name
+        self.ring = HashRing([])
+        logger.debug("%s:%s initialized with %s duration.",
+                     self.__class__.__name__, self.id, duration)
+
+    def get_instance_id(self):
+        """ Can be overridden, but a random UUID at launch is probably good
+        enough.
+        """
+        return uuid.uuid4().hex
+
+    def member_expired(self, expiry, now):
+        """ Returns True if the member's heartbeat is expired, False
+        otherwise.
+        """
+        if not expiry or int(now) > int(expiry):
+            return True
+        return False
+
+    def _heartbeat(self, expiry):
+        """ Should be overridden to record this member's heartbeat with the
+        given expiry, and return a dictionary of member id -> expiry for
+        every member in the group.
+        """
+        raise NotImplementedError
+
+    def leave(self):
+        """ Should be overridden to remove this member from the group. """
+        raise NotImplementedError
+
+    def heartbeat(self):
+        """ Records a heartbeat and rebuilds the ring from the members that
+        are still alive.  Returns True if the members changed.
+        """
+        now = time.time()
+        members = self._heartbeat(int(now) + self.duration)
+        alive = [member for member, expiry in members.iteritems()
+                 if not self.member_expired(expiry, now)]
+        if self.id not in alive:
+            alive.append(self.id)
+        if sorted(alive) == self.ring.members:
+            return False
+        logger.info("Scheduler members changed, now %d: %s", len(alive),
+                    ', '.join(sorted(alive)))
+        self.ring = HashRing(alive)
+        return True
+
+    def owns(self, key):
+        return self.ring.get_member(key) in (self.id, None)
+
+
+class LocalMembership(Membership):
+    """ Membership kept in a dictionary shared between instances in the
+    same process, for tests and single host setups.
+    """
+    groups = {}
+    _groups_lock = threading.Lock()
+
+    def _heartbeat(self, expiry):
+        with self._groups_lock:
+            members = self.groups.setdefault(self.group_name, {})
+            members[self.id] = expiry
+            return dict(members)
+
+    def leave(self):
+        with self._groups_lock:
+            self.groups.get(self.group_name, {}).pop(self.id, None)
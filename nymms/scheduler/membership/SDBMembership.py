@@ -0,0 +1,49 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+import time
+
+from nymms.scheduler.membership.Membership import Membership
+
+
+class SDBMembership(Membership):
+    """ Keeps scheduler heartbeats in an SDB domain, one item per scheduler.
+    """
+    def __init__(self, duration, conn, domain_name,
+                 group_name="schedulers"):
+        super(SDBMembership, self).__init__(duration, group_name)
+        self.conn = conn
+        self.domain_name = domain_name
+        self.domain = None
+
+    def setup_domain(self):
+        if self.domain:
+            return
+        logger.debug("Setting up membership domain %s", self.domain_name)
+        self.domain = self.conn.create_domain(self.domain_name)
+
+    def _heartbeat(self, expiry):
+        self.setup_domain()
+        logger.debug("Sending heartbeat for %s:%s", self.group_name, self.id)
+        self.domain.put_attributes(self.id, {'group': self.group_name,
+                                             'expiry': expiry},
+                                   replace=True)
+        query = "select * from `%s` where `group` = '%s'" % (
+            self.domain_name, self.group_name)
+        members = {}
+        now = time.time()
+        for item in self.domain.select(query, consistent_read=True):
+            expiry = int(item.get('expiry') or 0)
+            if self.member_expired(expiry + self.duration, now):
+                # Long gone, clean up after it
+                logger.debug("Removing expired member %s.", item.name)
+                self.domain.delete_attributes(item.name)
+                continue
+            members[item.name] = expiry
+        return members
+
+    def leave(self):
+        self.setup_domain()
+        logger.debug("Leaving %s:%s", self.group_name, self.id)
+        self.domain.delete_attributes(self.id)
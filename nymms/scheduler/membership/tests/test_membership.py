@@ -0,0 +1,75 @@
+import unittest
+
+from nymms.scheduler.membership.Membership import HashRing, LocalMembership
+
+DURATION = 30
+NODES = ['www%d' % i for i in range(1000)]
+
+
+class TestHashRing(unittest.TestCase):
+    def test_empty_ring(self):
+        self.assertIs(HashRing([]).get_member('www1'), None)
+
+    def test_balance(self):
+        ring = HashRing(['a', 'b', 'c'])
+        owners = [ring.get_member(node) for node in NODES]
+        for member in ('a', 'b', 'c'):
+            self.assertTrue(200 < owners.count(member) < 467)
+
+    def test_minimal_movement(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        for node in NODES:
+            owner = after.get_member(node)
+            # Nodes only ever move to the new member
+            if not owner == 'd':
+                self.assertEqual(owner, before.get_member(node))
+
+
+class TestLocalMembership(unittest.TestCase):
+    def setUp(self):
+        self.members = [LocalMembership(DURATION, group_name=self.id())
+                        for i in range(3)]
+        for member in self.members:
+            member.heartbeat()
+        # The first ones to heartbeat didn't know about the later ones
+        for member in self.members:
+            member.heartbeat()
+
+    def tearDown(self):
+        LocalMembership.groups.pop(self.id(), None)
+
+    def owners(self, members):
+        owners = {}
+        for node in NODES:
+            owning = [m.id for m in members if m.owns(node)]
+            self.assertEqual(len(owning), 1, node)
+            owners[node] = owning[0]
+        return owners
+
+    def test_each_node_owned_once(self):
+        owners = self.owners(self.members)
+        self.assertEqual(set(owners.values()),
+                         set(m.id for m in self.members))
+
+    def test_rebalance_on_leave(self):
+        before = self.owners(self.members)
+        gone = self.members.pop()
+        gone.leave()
+        for member in self.members:
+            self.assertTrue(member.heartbeat())
+        after = self.owners(self.members)
+        for node, owner in before.iteritems():
+            if not owner == gone.id:
+                self.assertEqual(after[node], owner)
+
+    def test_expired_member_dropped(self):
+        dead = self.members.pop()
+        LocalMembership.groups[self.id()][dead.id] = 1
+        for member in self.members:
+            self.assertTrue(member.heartbeat())
+            self.assertNotIn(dead.id, member.ring.members)
+        self.owners(self.members)
+
+    def test_unchanged_heartbeat(self):
+        self.assertFalse(self.members[0].heartbeat())
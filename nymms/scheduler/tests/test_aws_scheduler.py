@@ -0,0 +1,145 @@
+import unittest
+import base64
+import json
+
+from nymms.scheduler.aws_scheduler import AWSScheduler
+from nymms.schemas import Task
+
+
+class DummyBatchResults(object):
+    def __init__(self, errors):
+        self.errors = errors
+
+
+class DummyQueue(object):
+    def __init__(self, name, fail_ids=()):
+        self.name = name
+        self.fail_ids = set(fail_ids)
+        self.batches = []
+        self.written = []
+        self.depth = (0, 0)
+
+    def get_attributes(self, attributes='All'):
+        return {'ApproximateNumberOfMessages': str(self.depth[0]),
+                'ApproximateNumberOfMessagesNotVisible': str(self.depth[1])}
+
+    def write_batch(self, messages):
+        self.batches.append(messages)
+        errors = []
+        for entry_id, body, delay in messages:
+            if entry_id in self.fail_ids:
+                self.fail_ids.discard(entry_id)
+                errors.append({'id': entry_id, 'sender_fault': 'false',
+                               'error_code': 'InternalError',
+                               'error_message': 'Try again.'})
+            else:
+                task = json.loads(base64.b64decode(body))
+                self.written.append(task['id'])
+        return DummyBatchResults(errors)
+
+
+class DummySQS(object):
+    def __init__(self, queues):
+        self.queues = queues
+
+    def create_queue(self, name):
+        return self.queues[name]
+
+
+class DummyConnectionManager(object):
+    def __init__(self, queues):
+        self.sqs = DummySQS(queues)
+
+
+def make_task(node, monitor, realm=None):
+    return Task({'id': '%s:%s' % (node, monitor),
+                 'context': {'realm': realm}})
+
+
+class TestAWSSchedulerBatching(unittest.TestCase):
+    def setUp(self):
+        self.queues = {'tasks': DummyQueue('tasks', fail_ids=['3']),
+                       'tasks_REALM_a': DummyQueue('tasks_REALM_a')}
+        self.conn = DummyConnectionManager(self.queues)
+
+    def submit(self, scheduler, tasks):
+        for task in tasks:
+            scheduler.submit_task(task)
+        scheduler.flush_tasks()
+
+    def test_batches(self):
+        scheduler = AWSScheduler(None, self.conn, 'tasks', batch_size=10)
+        tasks = [make_task('www%d' % (i % 3), 'check_%d' % i)
+                 for i in range(25)]
+        tasks.append(make_task('www1', 'check_realm', realm='a'))
+        self.submit(scheduler, tasks)
+        queue = self.queues['tasks']
+        # 3 batches, plus the retry of the entry that failed
+        self.assertEqual([len(b) for b in queue.batches], [10, 1, 10, 5])
+        self.assertEqual(sorted(queue.written),
+                         sorted(t.id for t in tasks[:25]))
+        # Order (and so the per node interleaving) is kept within batches
+        self.assertEqual(queue.written[:3], [t.id for t in tasks[:3]])
+        self.assertEqual(self.queues['tasks_REALM_a'].written,
+                         ['www1:check_realm'])
+
+    def test_parallel_writers(self):
+        scheduler = AWSScheduler(None, self.conn, 'tasks', batch_size=10,
+                                 writers=3)
+        tasks = [make_task('www%d' % (i % 3), 'check_%d' % i)
+                 for i in range(45)]
+        self.submit(scheduler, tasks)
+        self.assertEqual(sorted(self.queues['tasks'].written),
+                         sorted(t.id for t in tasks))
+
+
+class TestAWSSchedulerBacklog(unittest.TestCase):
+    def setUp(self):
+        self.queues = {'tasks': DummyQueue('tasks'),
+                       'tasks_REALM_a': DummyQueue('tasks_REALM_a')}
+        self.conn = DummyConnectionManager(self.queues)
+        self.tasks = [make_task('www%d' % i, 'check') for i in range(100)]
+        self.realm_tasks = [make_task('www%d' % i, 'check', realm='a')
+                            for i in range(10)]
+
+    def sweep(self, scheduler):
+        scheduler.check_backlog(set([None, 'a']))
+        for task in self.tasks + self.realm_tasks:
+            scheduler.submit_task(task)
+        scheduler.flush_tasks()
+
+    def test_skip(self):
+        scheduler = AWSScheduler(None, self.conn, 'tasks', batch_size=10,
+                                 backlog_limit=50, backlog_policy='skip')
+        self.sweep(scheduler)
+        self.queues['tasks'].depth = (300, 20)
+        self.sweep(scheduler)
+        self.assertEqual(scheduler.backlog['tasks'], (300, 20))
+        self.assertEqual(scheduler.lag['tasks'], 3.0)
+        self.assertEqual(len(self.queues['tasks'].written), 100)
+        # Realm queues that aren't behind are left alone
+        self.assertEqual(len(self.queues['tasks_REALM_a'].written), 20)
+
+    def test_thin(self):
+        scheduler = AWSScheduler(None, self.conn, 'tasks', batch_size=10,
+                                 backlog_limit=50)
+        self.sweep(scheduler)
+        self.queues['tasks'].depth = (200, 0)
+        self.sweep(scheduler)
+        submitted = len(self.queues['tasks'].written) - 100
+        # A quarter of the tasks, give or take
+        self.assertTrue(5 < submitted < 50, submitted)
+        # Once it's caught up everything is sent again
+        self.queues['tasks'].depth = (10, 0)
+        self.sweep(scheduler)
+        self.assertEqual(len(self.queues['tasks'].written), 200 + submitted)
+
+    def test_first_sweep(self):
+        scheduler = AWSScheduler(None, self.conn, 'tasks', batch_size=10,
+                                 backlog_limit=50, backlog_policy='skip')
+        # Backed up before this scheduler has sent anything
+        self.queues['tasks'].depth = (300, 20)
+        self.sweep(scheduler)
+        self.assertEqual(scheduler.backlog['tasks'], (300, 20))
+        self.assertEqual(self.queues['tasks'].written, [])
+        self.assertEqual(len(self.queues['tasks_REALM_a'].written), 10)
@@ -0,0 +1,69 @@
+import unittest
+
+from nymms.resources import Node, MonitoringGroup
+from nymms.scheduler.backends.Backend import Backend
+
+
+class DummyBackend(Backend):
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.loads = 0
+
+    def _load_nodes(self):
+        self.loads += 1
+        return self.nodes
+
+
+class TestBackendReload(unittest.TestCase):
+    def setUp(self):
+        self.group = MonitoringGroup('reload_group')
+        self.backend = DummyBackend({
+            'reload_www1': {'monitoring_groups': ['reload_group']},
+            'reload_www2': {'address': '10.0.0.2'},
+            'reload_www3': None})
+        self.backend.load_nodes()
+
+    def tearDown(self):
+        for name in Node.registry.keys():
+            if name.startswith('reload_'):
+                Node.registry[name].unregister()
+        del MonitoringGroup.registry['reload_group']
+
+    def test_initial_load(self):
+        self.assertEqual(
+            sorted(n for n in Node.registry if n.startswith('reload_')),
+            ['reload_www1', 'reload_www2', 'reload_www3'])
+        self.assertIn('reload_www1', self.group.nodes)
+
+    def test_unchanged_reload(self):
+        www1 = Node.registry['reload_www1']
+        www1.monitors
+        version = self.backend.version
+        self.backend.load_nodes()
+        self.assertEqual(self.backend.version, version)
+        self.assertIs(Node.registry['reload_www1'], www1)
+
+    def test_incremental_reload(self):
+        www1 = Node.registry['reload_www1']
+        www2 = Node.registry['reload_www2']
+        self.backend.nodes = {
+            'reload_www1': {'monitoring_groups': ['reload_group']},
+            'reload_www2': {'address': '10.0.0.22'},
+            'reload_www4': {'monitoring_groups': ['reload_group']}}
+        self.backend.load_nodes()
+        # Unchanged nodes are left alone
+        self.assertIs(Node.registry['reload_www1'], www1)
+        # Changed nodes are rebuilt
+        self.assertIsNot(Node.registry['reload_www2'], www2)
+        self.assertEqual(Node.registry['reload_www2'].address, '10.0.0.22')
+        # Removed and added nodes
+        self.assertNotIn('reload_www3', Node.registry)
+        self.assertIn('reload_www4', Node.registry)
+        self.assertEqual(sorted(self.group.nodes.keys()),
+                         ['reload_www1', 'reload_www4'])
+
+    def test_reset(self):
+        www1 = Node.registry['reload_www1']
+        self.backend.load_nodes(reset=True)
+        self.assertIsNot(Node.registry['reload_www1'], www1)
+        self.assertEqual(self.group.nodes.keys(), ['reload_www1'])
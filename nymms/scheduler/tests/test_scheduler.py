@@ -0,0 +1,156 @@
+import unittest
+import time
+
+from nymms.scheduler.Scheduler import (Scheduler, DueTasks, splay,
+                                       _aligned_due, DISPATCH_SPREAD)
+
+
+class DummyScheduler(Scheduler):
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.submitted = []
+        super(DummyScheduler, self).__init__(None)
+
+    def get_tasks(self):
+        return dict((node, list(contexts))
+                    for node, contexts in self.tasks.iteritems())
+
+    def submit_task(self, task, **kwargs):
+        self.submitted.append((time.time(), task))
+
+
+def make_context(node, monitor):
+    return {'node': {'name': node}, 'monitor': {'name': monitor}}
+
+
+class TestSplay(unittest.TestCase):
+    def test_stable(self):
+        self.assertEqual(splay('www1:check_http', 300),
+                         splay(u'www1:check_http', 300))
+        offsets = [splay('www%d:check_http' % i, 300) for i in range(1000)]
+        self.assertTrue(all(0 <= offset < 300 for offset in offsets))
+        # Roughly even across the interval
+        first_half = len([o for o in offsets if o < 150])
+        self.assertTrue(400 < first_half < 600)
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = DummyScheduler({
+            'www1': [make_context('www1', 'a'), make_context('www1', 'b')],
+            'www2': [make_context('www2', 'a')]})
+
+    def test_burst(self):
+        self.scheduler.run_once(interval=300)
+        self.assertEqual(sorted(t.id for s, t in self.scheduler.submitted),
+                         ['www1:a', 'www1:b', 'www2:a'])
+
+    def test_compact_task(self):
+        context = make_context('www1', 'a')
+        context.update({'monitoringgroup': {'name': 'web'}, 'realm': None,
+                        'monitor_attr': 'x'})
+        self.assertEqual(self.scheduler.make_task(context).context, context)
+        self.scheduler.resources_version = 'v1'
+        task = self.scheduler.make_task(context)
+        self.assertEqual(task.id, 'www1:a')
+        self.assertEqual(task.reference, {'monitoringgroup': 'web',
+                                          'monitor': 'a', 'version': 'v1'})
+        self.assertEqual(task.context, {'node': {'name': 'www1'},
+                                        'realm': None})
+
+    def test_get_due_tasks(self):
+        slow = make_context('www1', 'b')
+        slow['interval'] = 3600
+        bad = make_context('www2', 'a')
+        bad['interval'] = 'often'
+        self.scheduler.tasks = {'www1': [make_context('www1', 'a'), slow],
+                                'www2': [bad]}
+        due_tasks = self.scheduler.get_due_tasks(300)
+        self.assertEqual(dict((k, v[1]) for k, v in due_tasks.iteritems()),
+                         {'www1:a': 300, 'www1:b': 3600, 'www2:a': 300})
+
+    def test_spread(self):
+        interval = 2
+        start = time.time()
+        window_start = start - (start % interval)
+        self.scheduler.run_once(interval=interval, dispatch=DISPATCH_SPREAD)
+        submitted = self.scheduler.submitted
+        self.assertEqual(len(submitted), 3)
+        offsets = [splay(task.id, interval) for s, task in submitted]
+        self.assertEqual(offsets, sorted(offsets))
+        for submit_time, task in submitted:
+            due = max(window_start + splay(task.id, interval), start)
+            self.assertAlmostEqual(submit_time, due, delta=0.1)
+            # Tasks are created when they're submitted, not up front
+            self.assertAlmostEqual(task.created.float_timestamp, submit_time,
+                                   delta=0.1)
+
+    def test_spread_windows_not_skipped(self):
+        class Done(Exception):
+            pass
+
+        class SlowFlushScheduler(DummyScheduler):
+            windows = []
+
+            def run_once(self, **kwargs):
+                if len(self.windows) == 3:
+                    raise Done()
+                self.windows.append(kwargs['window_start'])
+                super(SlowFlushScheduler, self).run_once(**kwargs)
+
+            def flush_tasks(self, **kwargs):
+                # A send_message_batch round trip
+                time.sleep(0.03)
+
+        scheduler = SlowFlushScheduler(dict(
+            ('www%d' % i, [make_context('www%d' % i, 'a')])
+            for i in range(50)))
+        with self.assertRaises(Done):
+            scheduler.run(interval=1, dispatch=DISPATCH_SPREAD)
+        windows = scheduler.windows
+        self.assertEqual(windows, [windows[0], windows[0] + 1,
+                                   windows[0] + 2])
+
+
+class TestDueTasks(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000000.0
+        self.due_tasks = DueTasks()
+        self.due_tasks.update({
+            'www1:fast': (make_context('www1', 'fast'), 60),
+            'www1:slow': (make_context('www1', 'slow'), 3600)}, self.now)
+
+    def due_ids(self, now):
+        return sorted('%s:%s' % (c['node']['name'], c['monitor']['name'])
+                      for c in self.due_tasks.pop_due(now))
+
+    def test_first_due_at_splay(self):
+        fast_due = _aligned_due('www1:fast', 60, self.now)
+        self.assertTrue(self.now <= fast_due < self.now + 60)
+        self.assertEqual(self.due_ids(fast_due - 0.01), [])
+        self.assertIn('www1:fast', self.due_ids(fast_due))
+
+    def test_per_task_intervals(self):
+        runs = {'www1:fast': 0, 'www1:slow': 0}
+        now = self.now
+        while now < self.now + 3600:
+            now = self.due_tasks.next_due()
+            for task_id in self.due_ids(now):
+                runs[task_id] += 1
+        self.assertEqual(runs['www1:slow'], 1)
+        self.assertIn(runs['www1:fast'], (60, 61))
+
+    def test_catch_up(self):
+        # The scheduler stalled for 5 intervals, each task only runs once
+        # and keeps its offset.
+        fast_due = _aligned_due('www1:fast', 60, self.now)
+        later = fast_due + 300 + 1
+        self.assertIn('www1:fast', self.due_ids(later))
+        self.assertEqual(self.due_ids(later), [])
+        self.assertEqual(self.due_tasks.next_due(), fast_due + 360)
+
+    def test_update(self):
+        self.due_tasks.update({
+            'www1:fast': (make_context('www1', 'fast'), 60)}, self.now)
+        self.assertEqual(len(self.due_tasks), 1)
+        self.assertEqual(self.due_ids(self.now + 3600), ['www1:fast'])
@@ -10,7 +10,8 @@ from nymms.schemas.types import (TimestampType, StateType, StateTypeType,
 from schematics.models import Model
 from schematics.transforms import blacklist
 from schematics.types import (
-    StringType, IPv4Type, UUIDType, IntType)
+    StringType, IPv4Type, UUIDType, IntType, FloatType)
+from schematics.types.compound import DictType
 import arrow
 
 
@@ -111,6 +112,10 @@ class Task(OriginModel):
     created = TimestampType(default=arrow.get)
     attempt = IntType(default=0)
     context = JSONType()
+    # Set on compact tasks, whose context only holds the node and any
+    # overrides.  The probe rebuilds the rest from its own resources, see
+    # nymms.resources.build_task_context.
+    reference = DictType(StringType(), serialize_when_none=False)
 
     def increment_attempt(self):
         self.attempt += 1
@@ -121,6 +126,8 @@ class Result(StateModel, OriginModel):
     timestamp = TimestampType(default=arrow.get)
     output = StringType()
     task_context = JSONType()
+    # Optional timing data from the probe, see nymms.probe.telemetry
+    telemetry = DictType(FloatType(), serialize_when_none=False)
 
     class Options:
         roles = {'strip_context': blacklist('task_context')}
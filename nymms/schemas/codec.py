@@ -0,0 +1,156 @@
+""" Encoding of Tasks & Results into the bodies of SQS & SNS messages.
+
+The default 'json' codec produces plain JSON, exactly as every version of
+NYMMS has, so that older probes & reactors can still read it.  Other codecs
+prefix the encoded message with a header of the form '<codec>.<version>:'
+so that readers can tell what they've been given; decode handles any of
+them, so readers should be upgraded before the writers switch codecs.
+
+The 'msgpack' codec (which needs the msgpack package) packs the whole
+message in a single pass, including the task context which JSON encodes as
+a string within the message, and base64 encodes the result so that it's
+safe to send through SQS & SNS.
+
+Independently of the codec, messages larger than a threshold can be
+compressed with zlib (see compress), which wraps the encoded message in a
+'zlib.1:' header.
+"""
+
+import base64
+import collections
+import json
+import logging
+import re
+import warnings
+import zlib
+
+logger = logging.getLogger(__name__)
+
+msgpack = None
+try:
+    import msgpack
+except ImportError:
+    warnings.warn("Unable to import msgpack - the msgpack codec is "
+                  "unavailable.", ImportWarning)
+
+from nymms.schemas.types import EMBED_JSON, _json_default
+
+DEFAULT_CODEC = 'json'
+
+ZLIB = 'zlib'
+ZLIB_VERSION = 1
+
+HEADER_RE = re.compile(r'^(?P<codec>[a-z]+)\.(?P<version>\d+):')
+
+
+class UnknownCodec(ValueError):
+    pass
+
+
+class Codec(object):
+    """ Converts models to & from message bodies. """
+    name = None
+    version = 1
+
+    def header(self):
+        return '%s.%d:' % (self.name, self.version)
+
+    def encode(self, model):
+        """ Returns the body of a message carrying the model. """
+        raise NotImplementedError
+
+    def decode(self, body):
+        """ Returns the primitive data, to build a model from, carried in a
+        message body (without the header).
+        """
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    name = 'json'
+
+    def encode(self, model):
+        # No header, so that this is readable by anything
+        return json.dumps(model.to_primitive())
+
+    def decode(self, body):
+        return json.loads(body)
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+
+    def __init__(self):
+        if not msgpack:
+            raise UnknownCodec("The msgpack codec needs the msgpack package.")
+
+    def encode(self, model):
+        data = model.to_primitive(context={EMBED_JSON: True})
+        packed = msgpack.packb(data, default=_json_default,
+                               use_bin_type=True)
+        return self.header() + base64.b64encode(packed)
+
+    def decode(self, body):
+        return msgpack.unpackb(base64.b64decode(body), raw=False)
+
+
+CODECS = collections.OrderedDict([
+    (JSONCodec.name, JSONCodec),
+    (MsgpackCodec.name, MsgpackCodec)])
+
+_codecs = {}
+
+
+def get_codec(name=None):
+    """ Returns the (shared) instance of the named codec. """
+    name = name or DEFAULT_CODEC
+    if name not in _codecs:
+        try:
+            _codecs[name] = CODECS[name]()
+        except KeyError:
+            raise UnknownCodec("Unknown codec '%s', valid codecs are: %s" % (
+                name, ', '.join(CODECS)))
+    return _codecs[name]
+
+
+def _check_version(name, version, supported):
+    if version > supported:
+        raise UnknownCodec("Message is %s version %d, only version %d and "
+                           "older are supported." % (name, version,
+                                                     supported))
+
+
+def compress(body, threshold):
+    """ Compresses message bodies longer than threshold bytes, as long as
+    that makes them smaller.  A threshold of 0 disables compression.
+    """
+    if not threshold or len(body) <= threshold:
+        return body
+    compressed = '%s.%d:%s' % (ZLIB, ZLIB_VERSION,
+                               base64.b64encode(zlib.compress(body)))
+    if len(compressed) >= len(body):
+        return body
+    logger.debug("Compressed message from %d to %d bytes.", len(body),
+                 len(compressed))
+    return compressed
+
+
+def encode(model, codec=None, compress_threshold=0):
+    return compress(get_codec(codec).encode(model), compress_threshold)
+
+
+def decode(body):
+    """ Returns the primitive data carried in a message body written by any
+    codec, compressed or not.
+    """
+    match = HEADER_RE.match(body)
+    if not match:
+        return get_codec(JSONCodec.name).decode(body)
+    name = match.group('codec')
+    version = int(match.group('version'))
+    if name == ZLIB:
+        _check_version(name, version, ZLIB_VERSION)
+        return decode(zlib.decompress(base64.b64decode(body[match.end():])))
+    codec = get_codec(name)
+    _check_version(name, version, codec.version)
+    return codec.decode(body[match.end():])
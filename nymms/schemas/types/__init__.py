@@ -33,6 +33,19 @@ class TimestampType(BaseType):
                                                          200 * year)))
 
 
+# Passed in the context of to_primitive to leave JSONType values as they
+# are, for codecs that encode the whole message in one go.
+EMBED_JSON = 'embed_json'
+
+
+def _json_default(value):
+    # Allows read-only mappings, like the layered contexts built by
+    # nymms.resources, to be serialized without copying them first.
+    if isinstance(value, collections.Mapping):
+        return dict(value)
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
 class JSONType(BaseType):
     def to_native(self, value, context=None):
         if isinstance(value, basestring):
@@ -40,7 +53,9 @@ class JSONType(BaseType):
         return value
 
     def to_primitive(self, value, context=None):
-        return json.dumps(value)
+        if context and context.get(EMBED_JSON):
+            return value
+        return json.dumps(value, default=_json_default)
 
     def _mock(self, context=None):
         return dict(
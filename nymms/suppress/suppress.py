@@ -1,4 +1,5 @@
 import logging
+import threading
 
 from nymms.schemas import Suppression
 
@@ -19,6 +20,7 @@ class SuppressionManager(object):
         self.cache_ttl = cache_ttl
         self._cache_expire_time = 0
         self._cached_suppressions = []
+        self._cache_lock = threading.Lock()
         self._backend = None
         self.schema_class = schema_class
         logger.debug("%s initialized.", self.__class__.__name__)
@@ -55,16 +57,19 @@ class SuppressionManager(object):
     def refresh_cache(self, now=None):
         logger.debug("Refreshing reactor suppression cache")
         now = now or arrow.get()
+        # Swap in the whole new list at once, so that reactor handlers
+        # checking suppressions from other threads never see it half built.
+        self._cached_suppressions = list(self.get_active_suppressions())
         self._cache_expire_time = now.timestamp + self.cache_ttl
-        self._cached_suppressions = []
-        for suppression in self.get_active_suppressions():
-            self._cached_suppressions.append(suppression)
 
     def get_current_suppressions(self, now=None):
         """Returns a list of currently active suppression filters"""
         now = now or arrow.get()
         if self.cache_expired(now):
-            self.refresh_cache(now)
+            with self._cache_lock:
+                # Another thread may have refreshed it while we waited
+                if self.cache_expired(now):
+                    self.refresh_cache(now)
         return self._cached_suppressions
 
     def is_suppressed(self, message, now=None):
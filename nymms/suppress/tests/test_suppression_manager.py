@@ -1,5 +1,7 @@
 import unittest
 import copy
+import threading
+import time
 
 from nymms.suppress.suppress import SuppressionManager
 from nymms.schemas import Suppression
@@ -22,7 +24,10 @@ class MockSuppressionManager(SuppressionManager):
     def migrate_suppressions(self):
         return
 
+    delay = 0
+
     def get_suppressions(self, expire, include_disabled=False):
+        time.sleep(self.delay)
         suppressions = copy.deepcopy(SUPPRESSIONS)
         for s in suppressions:
             s.update(SUPPRESSION_COMMON)
@@ -38,3 +43,15 @@ class TestBase(unittest.TestCase):
         self.assertFalse(self.suppression_manager.is_suppressed('woot'))
         self.assertTrue(self.suppression_manager.is_suppressed('test_foo'))
         self.assertTrue(self.suppression_manager.is_suppressed('test_barn'))
+
+    def test_refresh_from_threads(self):
+        manager = self.suppression_manager
+        manager.get_current_suppressions()
+        manager._cache_expire_time = 0
+        manager.delay = 0.2
+        refresh = threading.Thread(target=manager.get_current_suppressions)
+        refresh.start()
+        time.sleep(0.05)
+        # Another thread checking mid refresh still sees the suppressions
+        self.assertTrue(manager.is_suppressed('test_foo'))
+        refresh.join()
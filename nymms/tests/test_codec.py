@@ -0,0 +1,80 @@
+import unittest
+import json
+
+from nymms import resources
+from nymms.schemas import Task, Result, types, codec
+
+
+def make_task():
+    context = resources.LayeredContext({'node': {'name': 'www1'}},
+                                       {'monitor': {'name': u'check_\xe9'}})
+    return Task({'id': 'www1:check', 'context': context})
+
+
+class TestJSONCodec(unittest.TestCase):
+    def test_unchanged_format(self):
+        task = make_task()
+        body = codec.encode(task)
+        self.assertEqual(json.loads(body),
+                         json.loads(json.dumps(task.to_primitive())))
+        decoded = Task(codec.decode(body))
+        self.assertEqual(decoded.context['monitor']['name'], u'check_\xe9')
+
+    def test_header(self):
+        body = codec.get_codec('json').header() + codec.encode(make_task())
+        self.assertEqual(Task(codec.decode(body)).id, 'www1:check')
+        with self.assertRaises(codec.UnknownCodec):
+            codec.decode('json.99:{}')
+        with self.assertRaises(codec.UnknownCodec):
+            codec.decode('bogus.1:abc')
+        with self.assertRaises(codec.UnknownCodec):
+            codec.get_codec('bogus')
+
+
+class TestCompression(unittest.TestCase):
+    def test_threshold(self):
+        task = make_task()
+        small = codec.encode(task, compress_threshold=1024)
+        self.assertEqual(small, codec.encode(task))
+        task.context = {'big': 'x' * 4096}
+        body = codec.encode(task, compress_threshold=1024)
+        self.assertTrue(body.startswith('zlib.1:'))
+        self.assertLess(len(body), 1024)
+        self.assertEqual(Task(codec.decode(body)).context, task.context)
+        # Not compressed unless asked to be
+        self.assertFalse(codec.encode(task).startswith('zlib'))
+
+    def test_incompressible(self):
+        # Compressing something this small only makes it bigger
+        body = '{"a": 1}'
+        self.assertEqual(codec.compress(body, 1), body)
+
+
+@unittest.skipIf(codec.msgpack is None, "msgpack is not installed")
+class TestMsgpackCodec(unittest.TestCase):
+    def test_round_trip(self):
+        task = make_task()
+        body = codec.encode(task, 'msgpack')
+        self.assertTrue(body.startswith('msgpack.1:'))
+        data = codec.decode(body)
+        # The context is packed along with everything else
+        self.assertEqual(data['context']['node'], {'name': 'www1'})
+        decoded = Task(data)
+        self.assertEqual(decoded.context['monitor']['name'], u'check_\xe9')
+        self.assertEqual(decoded.created, task.created)
+
+    def test_result(self):
+        result = Result({'id': 'www1:check', 'state': types.STATE_CRITICAL,
+                         'state_type': types.STATE_TYPE_HARD,
+                         'output': 'down', 'task_context': {'a': 1}})
+        decoded = Result(codec.decode(codec.encode(result, 'msgpack')))
+        decoded.validate()
+        self.assertEqual(decoded.state, types.STATE_CRITICAL)
+        self.assertEqual(decoded.task_context, {'a': 1})
+
+    def test_compressed(self):
+        task = make_task()
+        task.context = {'big': 'x' * 4096}
+        body = codec.encode(task, 'msgpack', compress_threshold=1024)
+        self.assertTrue(body.startswith('zlib.1:'))
+        self.assertEqual(Task(codec.decode(body)).context, task.context)
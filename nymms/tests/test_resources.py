@@ -1,8 +1,11 @@
 import unittest
+import json
 from weakref import WeakValueDictionary
 
 from nymms import resources
+from nymms.schemas import Task
 from nymms.exceptions import MissingCommandContext
+from nymms.utils import commands, templates
 
 
 class TestNanoResources(unittest.TestCase):
@@ -52,3 +55,87 @@ class TestCommand(unittest.TestCase):
         c_out = c.format_command(context, private_context)
         self.assertEquals(c_out,
                           "/bin/echo public mypassword")
+
+    def test_python_command(self):
+        c = resources.Command('python_check_file',
+                              'nymms.probe.checks.check_file',
+                              command_type='python')
+        out = c.execute({'file_name': __file__}, 10)
+        self.assertIn('FILE OK', out)
+        with self.assertRaises(commands.CommandFailure) as cm:
+            c.execute({'file_name': __file__ + '.missing'}, 10)
+        self.assertEqual(cm.exception.return_code, 2)
+
+    def test_template_cache(self):
+        command = "/bin/echo {{public}}"
+        c1 = resources.Command('echo1', command)
+        c2 = resources.Command('echo2', command)
+        self.assertIs(c1.template, c2.template)
+        self.assertEquals(c2.format_command({'public': 'public'}),
+                          "/bin/echo public")
+
+    def test_template_cache_disabled(self):
+        c = resources.Command('echo_uncached', "/bin/echo {{public}}")
+        templates.configure_environment(cache_size=0)
+        try:
+            self.assertIsNot(c.template, c.template)
+        finally:
+            templates.configure_environment()
+        self.assertIs(c.template, c.template)
+
+
+class TestLayeredContext(unittest.TestCase):
+    def test_layer_priority(self):
+        base = {'a': 1, 'b': 1}
+        context = resources.LayeredContext(base).new_child({'b': 2, 'c': 2})
+        context = context.new_defaults({'a': 0, 'd': 0})
+        self.assertEqual(context.to_dict(), {'a': 1, 'b': 2, 'c': 2, 'd': 0})
+        self.assertEqual(len(context), 4)
+        self.assertEqual(sorted(context), ['a', 'b', 'c', 'd'])
+        # the layers underneath are never modified
+        self.assertEqual(base, {'a': 1, 'b': 1})
+
+    def test_json_serialization(self):
+        context = resources.LayeredContext({'a': 1}, {'b': {'c': 2}})
+        task = Task({'id': 'test', 'context': context})
+        self.assertEqual(json.loads(task.to_primitive()['context']),
+                         {'a': 1, 'b': {'c': 2}})
+
+    def test_node_context(self):
+        mg = resources.MonitoringGroup('layered_mg', group_attr='group',
+                                       shared='group')
+        c = resources.Command('layered_command', 'echo {{shared}}')
+        m = resources.Monitor('layered_monitor', command=c,
+                              monitoring_groups=[mg], shared='monitor')
+        node = resources.Node('layered_node', monitoring_groups=[mg],
+                              shared='node')
+        context = node.monitors[0]
+        self.assertEqual(context['node']['name'], node.name)
+        self.assertEqual(context['monitor']['name'], m.name)
+        self.assertEqual(context['group_attr'], 'group')
+        self.assertEqual(context['shared'], 'monitor')
+        self.assertEqual(c.format_command(context), 'echo monitor')
+
+    def test_compact_task_context(self):
+        mg = resources.MonitoringGroup('compact_mg', group_attr='group')
+        c = resources.Command('compact_command', 'echo {{shared}}')
+        resources.Monitor('compact_monitor', command=c, realm='east',
+                          monitoring_groups=[mg], shared='monitor')
+        node = resources.Node('compact_node', monitoring_groups=[mg],
+                              address='10.0.0.1', shared='node')
+        context = node.monitors[0]
+        reference, overrides = resources.compact_task_context(context)
+        self.assertEqual(reference, {'monitoringgroup': 'compact_mg',
+                                     'monitor': 'compact_monitor'})
+        self.assertEqual(overrides['realm'], 'east')
+        # Only what the scheduler sends makes it to the probe
+        task = Task({'id': 'test', 'context': overrides,
+                     'reference': reference})
+        task = Task(json.loads(json.dumps(task.to_primitive())))
+        rebuilt = resources.build_task_context(task.reference, task.context)
+        self.assertEqual(rebuilt.to_dict(), context.to_dict())
+        self.assertEqual(c.format_command(rebuilt), 'echo monitor')
+        with self.assertRaises(KeyError):
+            resources.build_task_context({'monitoringgroup': 'compact_mg',
+                                          'monitor': 'missing_monitor'},
+                                         overrides)
@@ -0,0 +1,64 @@
+import collections
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """ A thread-safe cache that holds at most max_size entries, evicting the
+    least recently used entry when it's full.
+
+    If ttl is given then entries older than ttl seconds are treated as
+    missing.
+    """
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self._get(key) is not _MISSING
+
+    def _get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return _MISSING
+            if expires is not None and expires < time.time():
+                logger.debug("Cache entry for %s has expired.", key)
+                return _MISSING
+            self._entries[key] = (expires, value)
+            return value
+
+    def get(self, key, default=None):
+        value = self._get(key)
+        if value is _MISSING:
+            return default
+        return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
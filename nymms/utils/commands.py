@@ -1,9 +1,44 @@
-import subprocess
+import collections
+import errno
+import os
+import re
+import select
+import shlex
 import signal
+import socket
+import time
 import logging
 
+import subprocess32 as subprocess
+
 logger = logging.getLogger(__name__)
 
+# How long to sleep between checks when waiting for a command that has
+# closed its output to exit.
+REAP_INTERVAL = 0.01
+
+# How much of the end of truncated output is searched for trailing perfdata.
+PERFDATA_WINDOW = 1024
+
+# Anything that needs a shell to interpret it: pipes, redirection, command
+# lists, subshells, variables, globs, comments and so on.
+SHELL_SYNTAX = re.compile(r'[|&;<>()$`*?\[\]{}~!#\n]|^\s*\w+=')
+
+# Whether commands without any shell syntax are exec'd directly rather than
+# through /bin/sh.  See configure().
+_direct_exec = True
+# If set, the nymms.utils.forkserver.ForkServer that commands are run in.
+_fork_server = None
+# The most output, in bytes, kept from any one command.  None for no limit.
+_max_output = None
+# Cache of executable name -> full path lookups.
+_executable_cache = {}
+
+CommandResult = collections.namedtuple('CommandResult',
+                                       ['command', 'return_code', 'output',
+                                        'timed_out', 'elapsed', 'cpu_user',
+                                        'cpu_system'])
+
 
 class CommandException(Exception):
     pass
@@ -30,43 +65,349 @@ class CommandFailure(CommandException):
             self.command, self.return_code,)
 
 
-def execute(command_string, timeout=None):
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def _kill_process_group(command_object):
+    try:
+        os.killpg(command_object.pid, signal.SIGKILL)
+    except OSError as e:
+        # The command exited between the deadline passing and the kill
+        if not e.errno == errno.ESRCH:
+            raise
+
+
+class OutputCapture(object):
+    """ Collects a command's output, keeping at most max_size bytes of it.
+
+    Once the limit is hit the rest of the output is thrown away as it is
+    read, apart from a small window at the end that is kept so that the
+    trailing perfdata from a nagios plugin's long output isn't lost.  The
+    first line (the plugin's status) is always at the start of what is kept.
     """
-    Execute a command with an optional timeout.  If the command takes longer
-    than timeout raise a CommandTimeout exception.  If the command fails raise
-    a CommandFailure exception.  Otherwise return stdout & stderr from the
-    command.
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.size = 0
+        self._head = []
+        self._head_size = 0
+        self._tail = ''
+
+    @property
+    def truncated(self):
+        return self.max_size is not None and self.size > self.max_size
+
+    def append(self, data):
+        self.size += len(data)
+        if self.max_size is not None:
+            room = self.max_size - self._head_size
+            if len(data) > room:
+                self._tail = (self._tail + data[room:])[-PERFDATA_WINDOW:]
+                data = data[:room]
+        if data:
+            self._head.append(data)
+            self._head_size += len(data)
+
+    def getvalue(self):
+        head = ''.join(self._head)
+        if not self.truncated:
+            return head
+        # Don't leave half a line at the end, unless it's the first line
+        if '\n' in head:
+            head = head[:head.rindex('\n') + 1]
+        else:
+            head += '\n'
+        output = head + '... (output truncated, %d of %d bytes kept)\n' % (
+            len(head), self.size)
+        if '|' in self._tail:
+            output += self._tail[self._tail.rindex('|'):]
+        return output
+
+
+def truncate_output(output, max_size=None):
+    """ Applies the same limit as OutputCapture to output that has already
+    been collected.
+    """
+    capture = OutputCapture(max_size)
+    capture.append(output)
+    return capture.getvalue()
+
+
+def _read_output(command_object, deadline, max_size=None):
+    """ Reads the command's output until it is closed or the deadline passes.
+
+    Output beyond max_size bytes is read and thrown away (see OutputCapture)
+    so that the command never blocks on a full pipe.  Returns a tuple of the
+    output kept and whether or not the deadline was hit.
+    """
+    fd = command_object.stdout.fileno()
+    poller = select.poll()
+    poller.register(fd, select.POLLIN | select.POLLPRI | select.POLLHUP)
+    capture = OutputCapture(max_size)
+    while True:
+        remaining = _remaining(deadline)
+        if remaining is not None and remaining <= 0:
+            return capture.getvalue(), True
+        wait = None if remaining is None else remaining * 1000
+        try:
+            events = poller.poll(wait)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if not events:
+            continue
+        data = os.read(fd, 4096)
+        if not data:
+            return capture.getvalue(), False
+        capture.append(data)
+
+
+def _reap(command_object, block=False):
+    """ Reaps the command with os.wait4 if it has exited, setting its
+    returncode.  Returns the command's resource usage, or None if it hasn't
+    exited (or its usage couldn't be collected).
+    """
+    while True:
+        try:
+            pid, status, rusage = os.wait4(command_object.pid,
+                                           0 if block else os.WNOHANG)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                # Already reaped elsewhere, let subprocess sort it out
+                command_object.poll()
+                return None
+            raise
+        if not pid:
+            return None
+        command_object._handle_exitstatus(status)
+        return rusage
+
+
+def _wait(command_object, deadline):
+    """ Waits for the command to exit.  Returns a tuple of whether or not it
+    exited before the deadline and its resource usage.
+    """
+    while True:
+        rusage = _reap(command_object)
+        if command_object.returncode is not None:
+            return True, rusage
+        remaining = _remaining(deadline)
+        if remaining is not None and remaining <= 0:
+            return False, None
+        if remaining is None:
+            remaining = REAP_INTERVAL
+        time.sleep(min(REAP_INTERVAL, remaining))
+
+
+def configure(direct_exec=True, fork_server=False, max_output=None):
+    """ Sets how commands are run by run_command and execute.
+
+    If fork_server is True then a fork server (see nymms.utils.forkserver)
+    is started, and commands are run there rather than being forked from
+    this process.  max_output limits how many bytes of output are kept from
+    each command.
+    """
+    global _direct_exec, _fork_server, _max_output
+    _direct_exec = direct_exec
+    _max_output = max_output or None
+    if _fork_server:
+        _fork_server.stop()
+        _fork_server = None
+    if fork_server:
+        from nymms.utils.forkserver import ForkServer
+        _fork_server = ForkServer(direct_exec=direct_exec,
+                                  max_output=_max_output)
+        _fork_server.start()
+
+
+def find_executable(name):
+    """ Returns the full path of an executable, looking it up in PATH the
+    first time it's asked for.  Returns None if it can't be found.
+    """
+    if os.path.sep in name:
+        return name
+    try:
+        return _executable_cache[name]
+    except KeyError:
+        pass
+    path = None
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        candidate = os.path.join(directory, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            path = candidate
+            break
+    if path:
+        _executable_cache[name] = path
+    return path
+
+
+def split_command(command_string):
+    """ Returns the argument list to exec a command directly, or None if the
+    command needs to be run by the shell.
+    """
+    if SHELL_SYNTAX.search(command_string):
+        return None
+    try:
+        args = shlex.split(command_string)
+    except ValueError:
+        return None
+    if not args:
+        return None
+    executable = find_executable(args[0])
+    if not executable:
+        # Let the shell handle (and report) commands it can't find
+        return None
+    args[0] = executable
+    return args
+
+
+def _spawn(command_string):
+    # subprocess32 creates its pipes close-on-exec, so checks started at the
+    # same time from other threads don't inherit this check's pipe (and
+    # hold it open past its exit), and close_fds only closes the fds that
+    # are actually open.  start_new_session calls setsid in the child
+    # without running any python there, which isn't safe with threads.
+    popen_args = dict(stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                      start_new_session=True, close_fds=True)
+    args = None
+    if _direct_exec:
+        args = split_command(command_string)
+    if args:
+        try:
+            return subprocess.Popen(args, **popen_args)
+        except OSError:
+            # Most likely the executable went away, forget where it was
+            # and let the shell deal with it.
+            logger.debug("Unable to exec %s directly, falling back to the "
+                         "shell.", args[0])
+            _executable_cache.pop(os.path.basename(args[0]), None)
+    return subprocess.Popen(command_string, shell=True, **popen_args)
+
+
+def run_command(command_string, timeout=None):
+    """
+    Runs a command, either in the fork server if one has been configured or
+    in this process, and returns a CommandResult.  Commands are only run
+    locally when the fork server can't be reached or has died; if it just
+    doesn't respond in time the result is marked as timed out.
+    """
+    if _fork_server:
+        from nymms.utils.forkserver import ForkServerError, ForkServerTimeout
+        start = time.time()
+        try:
+            return _fork_server.run_command(command_string, timeout)
+        except ForkServerTimeout as e:
+            # The command may still be running in the fork server, so running
+            # it again here could leave two copies going.
+            logger.error("%s", e)
+            return CommandResult(command_string, None, '', True,
+                                 time.time() - start, None, None)
+        except ForkServerError as e:
+            logger.error("%s Running command locally.", e)
+    return run_local_command(command_string, timeout)
+
+
+def run_local_command(command_string, timeout=None):
+    """
+    Runs a command, tracking its deadline itself rather than with signals, so
+    it can be used from any thread and by any number of commands at once.
+
+    Commands without any shell syntax are exec'd directly, saving a fork of
+    /bin/sh; everything else is run by the shell.  The command is started in
+    its own process group and if it hasn't finished by the deadline the
+    whole group is killed.  Only the first max_output bytes of output (see
+    configure) are kept.  Returns a CommandResult.
     """
-    def handle_sigalrm(signum, frame):
-        if signum == signal.SIGALRM:
-            logger.debug("Command '%s' timed out after %d seconds.",
-                         command_string, timeout)
-            raise CommandTimeout(command_string, timeout)
-    signal.signal(signal.SIGALRM, handle_sigalrm)
     log_header = "Executing command:"
-    # If a timeout is given, lets setup an alarm signal
+    deadline = None
     if timeout:
         log_header += " (timeout: %d)" % (timeout)
-        signal.alarm(timeout)
-    # Execute the command
+        deadline = time.time() + timeout
     logger.debug(log_header)
     logger.debug("    %s", command_string)
-    command_object = subprocess.Popen(command_string, shell=True,
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.STDOUT)
+    start = time.time()
+    command_object = _spawn(command_string)
     try:
-        output = command_object.communicate()
-    except CommandTimeout:
-        logger.debug("Command timed out, terminating child command.")
-        command_object.terminate()
-        raise
-    if not command_object.returncode == 0:
-        signal.alarm(0)
+        output, timed_out = _read_output(command_object, deadline,
+                                         _max_output)
+        rusage = None
+        if not timed_out:
+            exited, rusage = _wait(command_object, deadline)
+            timed_out = not exited
+        if timed_out:
+            logger.debug("Command '%s' timed out after %d seconds, killing "
+                         "process group %d.", command_string, timeout,
+                         command_object.pid)
+            _kill_process_group(command_object)
+            rusage = _reap(command_object, block=True)
+    finally:
+        command_object.stdout.close()
+    cpu_user = cpu_system = None
+    if rusage:
+        cpu_user, cpu_system = rusage.ru_utime, rusage.ru_stime
+    return CommandResult(command_string, command_object.returncode, output,
+                         timed_out, time.time() - start, cpu_user, cpu_system)
+
+
+def _update_stats(stats, elapsed, cpu_user=None, cpu_system=None):
+    if stats is not None:
+        stats.update({'elapsed': elapsed, 'cpu_user': cpu_user,
+                      'cpu_system': cpu_system})
+
+
+def execute(command_string, timeout=None, stats=None):
+    """
+    Execute a command with an optional timeout.  If the command takes longer
+    than timeout raise a CommandTimeout exception.  If the command fails raise
+    a CommandFailure exception.  Otherwise return stdout & stderr from the
+    command.
+
+    If stats is a dictionary, the command's elapsed time and user & system
+    cpu time are stored in it (whether or not the command succeeds).
+    """
+    result = run_command(command_string, timeout)
+    _update_stats(stats, result.elapsed, result.cpu_user, result.cpu_system)
+    if result.timed_out:
+        raise CommandTimeout(command_string, timeout)
+    if not result.return_code == 0:
         logger.debug("Command '%s' failed with return code %d:",
-                     command_string, command_object.returncode)
-        for line in output[0].split('\n'):
+                     command_string, result.return_code)
+        for line in result.output.split('\n'):
             logger.debug("    output: %s", line)
-        raise CommandFailure(command_string, command_object.returncode,
-                             output[0])
-    signal.alarm(0)
-    return output[0]
+        raise CommandFailure(command_string, result.return_code,
+                             result.output)
+    return result.output
+
+
+def execute_callable(name, func, context, timeout=None, stats=None):
+    """
+    Runs a python check in-process, with the same semantics as execute.
+
+    func is called with the command context and the timeout, and should
+    return a tuple of (return_code, output) where return_code follows the
+    nagios plugin exit codes.  A socket timeout raised by func is treated as
+    the check timing out.  Only the elapsed time is stored in stats, as cpu
+    time can't be measured per thread.
+    """
+    logger.debug("Executing callable: (timeout: %s)", timeout)
+    logger.debug("    %s", name)
+    start = time.time()
+    try:
+        return_code, output = func(context, timeout)
+    except socket.timeout:
+        logger.debug("Callable '%s' timed out after %s seconds.", name,
+                     timeout)
+        raise CommandTimeout(name, timeout)
+    finally:
+        _update_stats(stats, time.time() - start)
+    output = truncate_output(output, _max_output)
+    if not return_code == 0:
+        logger.debug("Callable '%s' failed with return code %d: %s", name,
+                     return_code, output)
+        raise CommandFailure(name, return_code, output)
+    return output
@@ -0,0 +1,223 @@
+""" A small helper process that runs commands on behalf of the probe.
+
+Forking gets slower the bigger the parent process is, and the probe has
+boto, jinja2, schematics and friends loaded.  The fork server is a separate,
+minimal python process started when the probe boots.  The probe sends it
+rendered command strings over a pipe, and it runs them (using
+nymms.utils.commands.run_local_command) and sends back the output, return
+code and timing.
+
+Messages in both directions are pickled and prefixed with their length.
+"""
+
+import cPickle as pickle
+import logging
+import os
+import struct
+import subprocess
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('!I')
+
+# Extra time given to the fork server, on top of the command's own timeout,
+# before the probe gives up waiting on it.
+RESPONSE_GRACE = 5
+
+
+class ForkServerError(Exception):
+    pass
+
+
+class ForkServerTimeout(ForkServerError):
+    """ The fork server is still running but didn't respond in time, so the
+    command may well still be running in it.
+    """
+    pass
+
+
+def read_message(fd):
+    header = _read_exactly(fd, HEADER.size)
+    if not header:
+        return None
+    (length,) = HEADER.unpack(header)
+    body = _read_exactly(fd, length)
+    if body is None:
+        return None
+    return pickle.loads(body)
+
+
+def _read_exactly(fd, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        data = os.read(fd, remaining)
+        if not data:
+            return None
+        chunks.append(data)
+        remaining -= len(data)
+    return ''.join(chunks)
+
+
+def write_message(fd, message):
+    body = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    data = HEADER.pack(len(body)) + body
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+class ForkServer(object):
+    """ The probe's side of the fork server.
+
+    run_command is thread-safe; any number of commands can be waiting on the
+    fork server at once.  If the fork server dies it is restarted the next
+    time a command is run.
+    """
+    def __init__(self, direct_exec=True, max_output=None):
+        self.direct_exec = direct_exec
+        self.max_output = max_output
+        self._process = None
+        self._next_id = 0
+        self._waiting = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        if self._process and self._process.poll() is None:
+            return
+        args = [sys.executable, '-m', 'nymms.utils.forkserver']
+        if not self.direct_exec:
+            args.append('--no-direct-exec')
+        if self.max_output:
+            args.append('--max-output=%d' % (self.max_output,))
+        self._process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         close_fds=True)
+        logger.debug("Started fork server, pid %d.", self._process.pid)
+        reader = threading.Thread(target=self._read_responses,
+                                  args=(self._process,),
+                                  name='fork-server-reader')
+        reader.daemon = True
+        reader.start()
+
+    def stop(self):
+        with self._lock:
+            process, self._process = self._process, None
+        if process:
+            process.stdin.close()
+            process.wait()
+
+    def _read_responses(self, process):
+        fd = process.stdout.fileno()
+        while True:
+            try:
+                response = read_message(fd)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                logger.exception("Unable to read from fork server:")
+                response = None
+            if response is None:
+                break
+            request_id, result = response
+            with self._lock:
+                waiter = self._waiting.pop(request_id, None)
+            if waiter:
+                waiter[1] = result
+                waiter[0].set()
+        waiting = []
+        with self._lock:
+            if self._process is process:
+                logger.error("Fork server (pid %d) exited.", process.pid)
+                self._process = None
+            if self._process is None:
+                # Nothing is coming back for anything still waiting
+                waiting = self._waiting.values()
+                self._waiting = {}
+        for waiter in waiting:
+            waiter[0].set()
+
+    def run_command(self, command_string, timeout=None):
+        """ Runs a command in the fork server, returning a CommandResult. """
+        waiter = [threading.Event(), None]
+        with self._lock:
+            self._start()
+            request_id = self._next_id
+            self._next_id += 1
+            self._waiting[request_id] = waiter
+            stdin = self._process.stdin.fileno()
+        try:
+            with self._write_lock:
+                write_message(stdin, (request_id, command_string, timeout))
+        except OSError as e:
+            with self._lock:
+                self._waiting.pop(request_id, None)
+            raise ForkServerError("Unable to send command to fork server: "
+                                  "%s" % (e,))
+        if timeout:
+            waiter[0].wait(timeout + RESPONSE_GRACE)
+        else:
+            # Event.wait without a timeout can't be interrupted in python 2,
+            # so wait in (long) steps instead.
+            while not waiter[0].is_set():
+                waiter[0].wait(60)
+        if waiter[1] is None:
+            with self._lock:
+                self._waiting.pop(request_id, None)
+            if waiter[0].is_set():
+                # Only set without a result when the fork server died
+                raise ForkServerError("Fork server exited while running "
+                                      "'%s'." % (command_string,))
+            raise ForkServerTimeout("No response from fork server for '%s'." %
+                                    (command_string,))
+        return waiter[1]
+
+
+def serve(direct_exec=True, max_output=None):
+    """ The fork server's main loop.  Reads commands from stdin, runs each
+    one in its own thread, and writes the results to stdout.
+    """
+    from nymms.utils import commands
+    commands.configure(direct_exec=direct_exec, max_output=max_output)
+    stdin = sys.stdin.fileno()
+    stdout = sys.stdout.fileno()
+    write_lock = threading.Lock()
+
+    def run(request_id, command_string, timeout):
+        try:
+            result = commands.run_local_command(command_string, timeout)
+        except Exception as e:
+            result = commands.CommandResult(command_string, 127,
+                                            "Unable to run command: %s" % e,
+                                            False, 0, None, None)
+        with write_lock:
+            write_message(stdout, (request_id, result))
+
+    while True:
+        request = read_message(stdin)
+        if request is None:
+            # The probe has gone away
+            break
+        worker = threading.Thread(target=run, args=request)
+        worker.daemon = True
+        worker.start()
+
+
+def main(argv):
+    direct_exec = True
+    max_output = None
+    for arg in argv:
+        if arg == '--no-direct-exec':
+            direct_exec = False
+        elif arg.startswith('--max-output='):
+            max_output = int(arg.split('=', 1)[1])
+    serve(direct_exec=direct_exec, max_output=max_output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
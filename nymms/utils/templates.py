@@ -1,4 +1,16 @@
+import logging
+
+from jinja2 import Environment, FunctionLoader, FileSystemBytecodeCache
 from jinja2 import Undefined
+from jinja2.runtime import StrictUndefined
+
+logger = logging.getLogger(__name__)
+
+# The number of compiled templates to keep around.  Set to 0 to disable the
+# cache, or -1 to never evict templates from it.
+DEFAULT_CACHE_SIZE = 400
+
+_environment = None
 
 
 class SimpleUndefined(Undefined):
@@ -20,3 +32,42 @@ class SimpleUndefined(Undefined):
 
     def __getitem__(self, item):
         return u'{{MISSING_CONTEXT}}'
+
+
+def _load_source(source):
+    # Templates are looked up by their source, which never changes, so
+    # they're always up to date.
+    return source, None, lambda: True
+
+
+def configure_environment(cache_size=DEFAULT_CACHE_SIZE,
+                          bytecode_cache_dir=None):
+    """ Sets up the shared jinja Environment used to render command strings.
+
+    Compiled templates are kept in a bounded LRU keyed by the template
+    source.  If bytecode_cache_dir is given the compiled bytecode is also
+    written to disk so that restarted processes don't have to compile every
+    template again.
+    """
+    global _environment
+    bytecode_cache = None
+    if bytecode_cache_dir:
+        logger.debug("Using template bytecode cache in %s.",
+                     bytecode_cache_dir)
+        bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+    _environment = Environment(loader=FunctionLoader(_load_source),
+                               undefined=StrictUndefined,
+                               cache_size=cache_size,
+                               bytecode_cache=bytecode_cache)
+    return _environment
+
+
+def get_environment():
+    if not _environment:
+        configure_environment()
+    return _environment
+
+
+def get_template(source):
+    """ Returns the compiled Template for the given source string. """
+    return get_environment().get_template(source)
@@ -1,4 +1,8 @@
 import unittest
+import os
+import signal
+import threading
+import time
 
 from nymms.utils import commands
 
@@ -16,3 +20,140 @@ class TestCommands(unittest.TestCase):
     def test_execute_success(self):
         out = commands.execute('echo test', 10)
         self.assertEqual(out, 'test\n')
+
+    def test_execute_timeout_in_thread(self):
+        errors = []
+
+        def run():
+            try:
+                commands.execute('sleep 2', 1)
+            except commands.CommandTimeout as e:
+                errors.append(e)
+
+        t = threading.Thread(target=run)
+        t.start()
+        t.join(5)
+        self.assertEqual(len(errors), 1)
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), "needs /proc")
+    def test_commands_dont_inherit_fds(self):
+        # Stands in for the pipe of a check started from another thread,
+        # which would otherwise be held open until this command exits.
+        r, w = os.pipe()
+        os.dup2(w, 50)
+        try:
+            out = commands.execute('ls /proc/self/fd', 10)
+        finally:
+            for fd in (r, w, 50):
+                os.close(fd)
+        self.assertNotIn('50', out.split())
+
+    def test_execute_timeout_kills_process_group(self):
+        start = time.time()
+        with self.assertRaises(commands.CommandTimeout):
+            # The backgrounded sleep holds the output pipe open, so this
+            # only returns early if the whole process group is killed.
+            commands.execute('sleep 5 & sleep 5', 1)
+        self.assertLess(time.time() - start, 4)
+
+    def test_run_command(self):
+        result = commands.run_command('echo test; exit 2', 10)
+        self.assertEqual(result.return_code, 2)
+        self.assertEqual(result.output, 'test\n')
+        self.assertFalse(result.timed_out)
+
+    def test_split_command(self):
+        args = commands.split_command("echo 'hello world'")
+        self.assertEqual(os.path.basename(args[0]), 'echo')
+        self.assertEqual(args[1:], ['hello world'])
+        for command in ('echo $HOME', 'echo a | cat', 'sleep 1 &',
+                        'echo a > /dev/null', 'ls *', 'FOO=1 env',
+                        'xxxps auwwwx'):
+            self.assertIs(commands.split_command(command), None, command)
+
+    def test_execute_without_direct_exec(self):
+        commands.configure(direct_exec=False)
+        try:
+            self.assertEqual(commands.execute('echo test', 10), 'test\n')
+        finally:
+            commands.configure(direct_exec=True)
+
+    def test_fork_server(self):
+        commands.configure(fork_server=True)
+        try:
+            self.assertEqual(commands.execute('echo test', 10), 'test\n')
+            result = commands.run_command('echo test; exit 2', 10)
+            self.assertEqual(result.return_code, 2)
+            self.assertEqual(result.output, 'test\n')
+            with self.assertRaises(commands.CommandTimeout):
+                commands.execute('sleep 2', 1)
+        finally:
+            commands.configure()
+        self.assertIs(commands._fork_server, None)
+
+    def test_fork_server_no_response(self):
+        from nymms.utils import forkserver
+        commands.configure(fork_server=True)
+        grace = forkserver.RESPONSE_GRACE
+        forkserver.RESPONSE_GRACE = 0
+        server = commands._fork_server
+        server.start()
+        pid = server._process.pid
+        os.kill(pid, signal.SIGSTOP)
+        try:
+            # The command must not be run again locally
+            with self.assertRaises(commands.CommandTimeout):
+                commands.execute('echo test', 1)
+        finally:
+            os.kill(pid, signal.SIGCONT)
+            forkserver.RESPONSE_GRACE = grace
+            commands.configure()
+
+    def test_fork_server_died(self):
+        commands.configure(fork_server=True)
+        server = commands._fork_server
+        server.start()
+        killer = threading.Timer(0.5, os.kill, (server._process.pid,
+                                                signal.SIGKILL))
+        killer.start()
+        try:
+            # Run locally instead
+            result = commands.run_command('sleep 1; echo test', 10)
+            self.assertEqual(result.output, 'test\n')
+            self.assertFalse(result.timed_out)
+        finally:
+            killer.cancel()
+            commands.configure()
+
+    def test_max_output(self):
+        commands.configure(max_output=100)
+        try:
+            result = commands.run_command(
+                "echo 'OK - status|time=1s'; yes filler | head -c 1000000; "
+                "echo; echo 'last line|size=10B'", 10)
+        finally:
+            commands.configure()
+        self.assertFalse(result.timed_out)
+        self.assertEqual(result.return_code, 0)
+        lines = result.output.split('\n')
+        self.assertEqual(lines[0], 'OK - status|time=1s')
+        self.assertIn('output truncated', result.output)
+        self.assertTrue(result.output.endswith('|size=10B\n'))
+        self.assertLess(len(result.output), 300)
+
+    def test_truncate_output(self):
+        self.assertEqual(commands.truncate_output('abc\n', 10), 'abc\n')
+        self.assertEqual(commands.truncate_output('abc\n', None), 'abc\n')
+        output = commands.truncate_output('first line\nsecond line\n', 15)
+        self.assertTrue(output.startswith('first line\n... (output'))
+
+    def test_execute_stats(self):
+        stats = {}
+        commands.execute('true', 10, stats=stats)
+        self.assertEqual(set(stats.keys()),
+                         set(['elapsed', 'cpu_user', 'cpu_system']))
+        self.assertIsNotNone(stats['cpu_user'])
+        stats = {}
+        with self.assertRaises(commands.CommandTimeout):
+            commands.execute('sleep 2', 1, stats=stats)
+        self.assertGreaterEqual(stats['elapsed'], 1)
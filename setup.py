@@ -17,12 +17,17 @@ install_requires = [
     "validictory>=1.0.0",
     "Werkzeug>=0.10.1",
     "Flask-API>=0.6.6.post1",
+    "subprocess32>=3.5.0",
 ]
 
 tests_require = [
     'nose>=1.0',
 ]
 
+extras_require = {
+    'msgpack': ['msgpack>=0.5.2'],
+}
+
 
 def read(filename):
     full_path = os.path.join(src_dir, filename)
@@ -48,5 +53,6 @@ if __name__ == '__main__':
         scripts=glob.glob(os.path.join(src_dir, 'scripts', 'nymms_*')),
         install_requires=install_requires,
         tests_require=tests_require,
+        extras_require=extras_require,
         test_suite='nose.collector',
     )